@@ -1,6 +1,6 @@
 from utils.data import samples_from_conll, get_tags
 from utils.ud import get_num_rel, get_num_upos
-from pyconll import load_from_file
+from utils.conll import load_file
 
 
 class Data:
@@ -16,9 +16,9 @@ class Data:
         :param use_v1: True if sentence is annotated using UD V1.2
         """
         self.samples = []
-        train_conll = load_from_file(train)
-        dev_conll = load_from_file(dev)
-        test_conll = load_from_file(test)
+        train_conll = load_file(train)
+        dev_conll = load_file(dev)
+        test_conll = load_file(test)
         self.train = samples_from_conll(train_conll, use_v1, hack_v2)
         self.dev = samples_from_conll(dev_conll, use_v1, hack_v2)
         self.test = samples_from_conll(test_conll, use_v1, hack_v2)
@@ -1,11 +1,13 @@
+from collections import OrderedDict
 from utils.data import sample_from_sentence, get_sentence_text
-from utils.reinflection import get_feats
-from sigmorphon_reinflection.decode import decode_word
+from utils.reinflection import flip_gender, get_feats
+from sigmorphon_reinflection.decode import decode_word, decode_words
 
 
 class SentenceConversion:
     """
-    Class to convert he gender of a word in a sentence
+    Class to convert he gender of a word in a sentence. The sentence is never modified, so it can be shared by all
+    conversions of the same sentence
     """
     def __init__(self, sentence, changes, use_v1, hack_v2):
         self.sentence = sentence
@@ -16,28 +18,37 @@ class SentenceConversion:
     def _tag_value(self, is_masc):
         return 2 if is_masc else 1
 
-    def _change_line(self, token, reinflection_model=None, device=None, decode_fn=None, decode_trg=None):
-        is_masc = token.feats['Gender'].pop() == 'Masc'
-        token.feats['Gender'].add('Fem' if is_masc else 'Masc')
-        line = token.conll()
-        parts = line.split("\t")
+    def _change_line(self, token, new_form):
+        parts = token.conll().split("\t")
         for change in self.changes:
             if int(token.id) == change[0]:
                 parts[2] = change[2]
-        tags = get_feats(token)
-        new_form = decode_word(token.lemma, tags, reinflection_model, device, decode_fn, decode_trg)
         parts[1] = new_form
         return "\t".join(parts)
 
-    def change_forms(self, form_idxs, reinflection_model, device, decode_fn, decode_trg):
+    def tokens_to_change(self, form_idxs, swap=False):
         """
-        Change the forms of a selection of words in the sentence using a reinflection model
+        Select the tokens whose gender changes in the converted sentence
 
-        :param form_idxs: word indices to change
-        :param reinflection_model: reinflection model
-        :param device: device related to reinflection model
-        :param decode_fn: Decoding function
-        :param decode_trg: Decoding target
+        :param form_idxs: word indices to change besides the animate nouns of the conversion
+        :param swap: True if the tokens are changed by a naive swap, which changes the animate nouns without checking
+        their lemma and gender
+        :return: dictionary from the index of each token in the sentence to a copy of the token with the new gender
+        """
+        tokens = {}
+        change_ids = [change[0] - 1 for change in self.changes]
+        for i in range(len(self.sentence)):
+            token = self.sentence[i]
+            if not token.is_multiword() and int(token.id) - 1 in form_idxs + change_ids:
+                if swap or (token.lemma and len(token.feats["Gender"]) == 1):
+                    # The sentence is shared with other conversions, so the gender is changed on a copy of the token
+                    tokens[i] = flip_gender(token)
+        return tokens
+
+    def render(self, tokens, forms):
+        """
+        :param tokens: tokens to change, as returned by tokens_to_change
+        :param forms: new form of each token to change
         :return: UD style string of new sentence
         """
         lines = []
@@ -46,67 +57,193 @@ class SentenceConversion:
             for change in self.changes:
                 change_id += "-" + str(change[0]) + "-" + ("M" if change[-1] else "F")
             lines.append("# sent_id = " + self.sentence.id + change_id)
-        change_ids = [change[0] - 1 for change in self.changes]
+        new_forms = dict(zip(tokens, forms))
         for i in range(len(self.sentence)):
-            token = self.sentence[i]
-            line = token.conll()
-            if not token.is_multiword() and int(token.id) - 1 in form_idxs + change_ids:
-                if token.lemma and len(token.feats["Gender"]) == 1:
-                    line = self._change_line(token, reinflection_model, device, decode_fn, decode_trg)
-            lines.append(line)
+            if i in tokens:
+                lines.append(self._change_line(tokens[i], new_forms[i]))
+            else:
+                lines.append(self.sentence[i].conll())
         return "\n".join(lines)
 
-    def apply(self, model, psi, reinflection_model, device, decode_fn, decode_trg):
+    def change_forms(self, form_idxs, reinflection_model, device, decode_fn, decode_trg, cache=None, swap=False):
         """
-        Apply the necessary transformation to the sentence
+        Change the forms of a selection of words in the sentence using a reinflection model
 
-        :param model: model to predict which words must change
-        :param psi: psi parameter for model
-        :param reinflection_model:
+        :param form_idxs: word indices to change
+        :param reinflection_model: reinflection model
         :param device: device related to reinflection model
         :param decode_fn: Decoding function
         :param decode_trg: Decoding target
+        :param cache: ReinflectionCache, None to always run the reinflection model
+        :param swap: True if the animate nouns are changed without checking their lemma and gender
         :return: UD style string of new sentence
         """
+        tokens = self.tokens_to_change(form_idxs, swap)
+        forms = [decode_word(token.lemma, get_feats(token), reinflection_model, device, decode_fn, decode_trg, cache)
+                 for token in tokens.values()]
+        return self.render(tokens, forms)
+
+    def get_sample(self):
+        """
+        :return: sample of the sentence and the tags the animate nouns are fixed to
+        """
         sample = sample_from_sentence(self.sentence, self.use_v1, self.hack_v2)
-        phi = model.create_phi(sample.T, sample.pos, sample.m)
+        return sample, self.get_fixes()
 
-        fixes = []
-        for change in self.changes:
-            fixes.append((change[0], self._tag_value(change[-1])))
+    def get_fixes(self):
+        """
+        :return: list of pairs of index of an animate noun and the tag it is fixed to
+        """
+        return [(change[0], self._tag_value(change[-1])) for change in self.changes]
 
-        best_tags = model.best_sequence(sample.T, sample.pos, psi, phi, fixes)
+    def get_form_idxs(self, sample, best_tags):
+        """
+        :param sample: sample of the sentence
+        :param best_tags: best tag sequence of the sentence with the animate nouns fixed
+        :return: indices of the words whose gender must change besides the animate nouns
+        """
         original_tags = sample.m
         tags_to_change = []
         change_ids = [change[0] - 1 for change in self.changes]
         for i in range(len(original_tags)):
             if original_tags[i] != 0 and original_tags[i] != best_tags[i] and i not in change_ids:
                 tags_to_change.append(i)
-        sentence = self.change_forms(tags_to_change, reinflection_model, device, decode_fn, decode_trg)
-        return sentence
+        return tags_to_change
 
-    def apply_swap(self, reinflection_model, device, decode_fn, decode_trg):
+    def apply(self, model, psi, reinflection_model, device, decode_fn, decode_trg, cache=None):
+        """
+        Apply the necessary transformation to the sentence
+
+        :param model: model to predict which words must change
+        :param psi: psi parameter for model
+        :param reinflection_model:
+        :param device: device related to reinflection model
+        :param decode_fn: Decoding function
+        :param decode_trg: Decoding target
+        :param cache: ReinflectionCache, None to always run the reinflection model
+        :return: UD style string of new sentence
+        """
+        sample, fixes = self.get_sample()
+        phi = model.create_phi(sample.T, sample.pos, sample.m)
+        best_tags = model.best_sequence(sample.T, sample.pos, psi, phi, fixes)
+        tags_to_change = self.get_form_idxs(sample, best_tags)
+        return self.change_forms(tags_to_change, reinflection_model, device, decode_fn, decode_trg, cache)
+
+    def apply_swap(self, reinflection_model, device, decode_fn, decode_trg, cache=None):
         """
         Apply a naive swap of only the words that should be changed
         :param reinflection_model:
         :param device: device related to reinflection model
         :param decode_fn: Decoding function
         :param decode_trg: Decoding target
+        :param cache: ReinflectionCache, None to always run the reinflection model
         :return: UD style string of new sentence
         """
-        lines = []
-        if self.sentence.id:
-            change_id = ""
-            for change in self.changes:
-                change_id += "-" + str(change[0]) + "-" + ("M" if change[-1] else "F")
-            lines.append("# sent_id = " + self.sentence.id + change_id)
-        change_ids = [change[0] - 1 for change in self.changes]
-        for i in range(len(self.sentence)):
-            token = self.sentence[i]
-            line = token.conll()
-            if not token.is_multiword() and int(token.id) - 1 in change_ids:
-                is_masc = token.feats['Gender'].pop() == 'Masc'
-                token.feats['Gender'].add('Fem' if is_masc else 'Masc')
-                line = self._change_line(token, reinflection_model, device, decode_fn, decode_trg)
-            lines.append(line)
-        return "\n".join(lines)
+        return self.change_forms([], reinflection_model, device, decode_fn, decode_trg, cache, swap=True)
+
+
+def apply_batch(conversions, model, psi, reinflection_model, device, decode_fn, decode_trg, cache=None,
+                batch_size=256):
+    """
+    Apply many conversions at once: the best tags of all sentences and of all combinations of changes of a sentence are
+    found with batched max-product, the words that need to be reinflected are collected from all conversions and
+    reinflected in batches, and only then the new sentences are written
+
+    :param conversions: list of SentenceConversion
+    :param model: model to predict which words must change
+    :param psi: psi parameter for model
+    :param reinflection_model: reinflection model
+    :param device: device related to reinflection model
+    :param decode_fn: Decoding function
+    :param decode_trg: Decoding target
+    :param cache: ReinflectionCache, None to always run the reinflection model
+    :param batch_size: number of words reinflected at once
+    :return: list of UD style strings of new sentences, None for conversions that failed
+    """
+    # Phase 1: max-product for all conversions. Conversions of the same sentence only differ in their fixed tags, so
+    # each sentence is converted to a sample once and all its combinations are decoded in the same pass
+    groups = OrderedDict()
+    for i, sc in enumerate(conversions):
+        groups.setdefault(id(sc.sentence), []).append(i)
+    samples = [None] * len(conversions)
+    # Sentences with the same number of combinations share a batch with phi of dimension [num_combinations, ...]
+    buckets = OrderedDict()
+    for group in groups.values():
+        try:
+            sample = conversions[group[0]].get_sample()[0]
+            phi = model.create_phi(sample.T, sample.pos, sample.m)
+        except (ValueError, IndexError):
+            continue
+        idxs, fixes = [], []
+        for i in group:
+            sample_fixes = conversions[i].get_fixes()
+            if any(idx > len(sample.T) for idx, _ in sample_fixes):
+                continue
+            samples[i] = sample
+            idxs.append(i)
+            fixes.append(sample_fixes)
+        if idxs:
+            buckets.setdefault(len(idxs), []).append((sample, phi, idxs, fixes))
+    best_tags = [None] * len(conversions)
+    for bucket in buckets.values():
+        try:
+            bucket_samples, bucket_phis, _, bucket_fixes = zip(*bucket)
+            batch_tags = model.best_sequences_batch([sample.T for sample in bucket_samples],
+                                                    [sample.pos for sample in bucket_samples], psi, list(bucket_phis),
+                                                    list(bucket_fixes))
+        except (ValueError, IndexError):
+            # A malformed tree spoils the whole batch, so only the sentences that fail on their own are skipped
+            batch_tags = []
+            for sample, phi, _, fixes in bucket:
+                try:
+                    batch_tags.append(model.best_sequences(sample.T, sample.pos, psi, phi, fixes))
+                except (ValueError, IndexError):
+                    batch_tags.append([None] * len(fixes))
+        for (_, _, idxs, _), tags in zip(bucket, batch_tags):
+            for i, combination_tags in zip(idxs, tags):
+                best_tags[i] = combination_tags
+
+    # Phase 2: reinflect the words of all conversions at once
+    tokens = [None] * len(conversions)
+    for i, sample in enumerate(samples):
+        if best_tags[i] is None:
+            continue
+        try:
+            tokens[i] = conversions[i].tokens_to_change(conversions[i].get_form_idxs(sample, best_tags[i]))
+        except (ValueError, IndexError, KeyError):
+            continue
+
+    def reinflect(words):
+        return decode_words([token.lemma for token in words], [get_feats(token) for token in words],
+                            reinflection_model, device, decode_fn, decode_trg, batch_size, cache)
+
+    forms = [None] * len(conversions)
+    try:
+        words = [token for sc_tokens in tokens if sc_tokens is not None for token in sc_tokens.values()]
+        batch_forms = reinflect(words)
+        start = 0
+        for i, sc_tokens in enumerate(tokens):
+            if sc_tokens is not None:
+                forms[i] = batch_forms[start:start + len(sc_tokens)]
+                start += len(sc_tokens)
+    except (ValueError, IndexError, KeyError):
+        # A word that cannot be reinflected spoils the whole batch, so only the conversions that fail on their own
+        # are skipped
+        for i, sc_tokens in enumerate(tokens):
+            if sc_tokens is None:
+                continue
+            try:
+                forms[i] = reinflect(list(sc_tokens.values()))
+            except (ValueError, IndexError, KeyError):
+                continue
+
+    # Phase 3: write the new sentences with the reinflected forms
+    sentences = [None] * len(conversions)
+    for i, sc in enumerate(conversions):
+        if forms[i] is None:
+            continue
+        try:
+            sentences[i] = sc.render(tokens[i], forms[i])
+        except (ValueError, IndexError, KeyError):
+            continue
+    return sentences
@@ -1,87 +1,110 @@
 from utils.data import get_sentence_text
+from utils.lexicon import load_lexicon
 from SentenceConversion import SentenceConversion
-from copy import deepcopy
 from tqdm import tqdm
 from itertools import combinations
+from random import Random
+from zlib import crc32
 import pickle
 
 
-def get_fem_word(masc_word, words):
+def get_change_combinations(changes, policy="all", max_combinations=None, key=""):
     """
-    :param masc_word: masculine word to convert
-    :param words: list of English-Femining-Masculine word triples
-    :return: feminine inflection of masculine word
-    """
-    for _, fem_word, word in words:
-        if masc_word == word:
-            return fem_word
-    raise ValueError(masc_word)
-
+    Generate the combinations of changes to apply to a sentence
 
-def get_masc_word(fem_word, words):
+    :param changes: list of possible changes in a sentence
+    :param policy: "all" for all non-empty subsets of changes, "singletons" for every change on its own, "all_at_once"
+    for all changes together
+    :param max_combinations: maximum number of combinations per sentence, if the policy gives more combinations a
+    subset of them is sampled. None for no maximum
+    :param key: string identifying the sentence, used to seed the sampling so that it is deterministic
+    :return: generator of tuples of changes
     """
-    :param fem_word: feminine word to convert
-    :param words: list of English-Femining-Masculine word triples
-    :return: masculine inflection of feminine word
-    """
-    for _, word, masc_word in words:
-        if fem_word == word:
-            return masc_word
-    raise ValueError(fem_word)
+    if max_combinations is not None and max_combinations < 0:
+        raise ValueError("max_combinations cannot be negative: " + str(max_combinations))
+    if not changes:
+        return
+    if policy == "all":
+        num_combinations = 2 ** len(changes) - 1
+        if max_combinations is None or num_combinations <= max_combinations:
+            for r in range(1, len(changes) + 1):
+                yield from combinations(changes, r)
+            return
+        # Sample without enumerating the power set, every subset is a non-zero bit mask over the changes
+        rng = Random(crc32((key + repr(changes)).encode("utf-8")))
+        masks = set()
+        while len(masks) < max_combinations:
+            mask = rng.getrandbits(len(changes))
+            if mask:
+                masks.add(mask)
+        for mask in sorted(masks, key=lambda mask: (bin(mask).count("1"), mask)):
+            yield tuple(changes[j] for j in range(len(changes)) if mask >> j & 1)
+    elif policy == "singletons":
+        singletons = [(change,) for change in changes]
+        if max_combinations is not None and len(singletons) > max_combinations:
+            rng = Random(crc32((key + repr(changes)).encode("utf-8")))
+            singletons = [singletons[j] for j in sorted(rng.sample(range(len(singletons)), max_combinations))]
+        yield from singletons
+    elif policy == "all_at_once":
+        if max_combinations is None or max_combinations > 0:
+            yield tuple(changes)
+    else:
+        raise ValueError("Unknown combination policy: " + policy)
 
 
-def get_animate_samples(conll, animate_file, use_v1, hack_v2):
+def iter_animate_samples(conll, lexicon, use_v1, hack_v2, policy="all", max_combinations=None):
     """
     :param conll: conll object
-    :param animate_file: file containing animate noun pairs
+    :param lexicon: AnimacyLexicon of animate noun pairs
     :param use_v1: True if sentence is annotated using UD V1.2
     :param hack_v2: True if sentence should be made into UD V2 from V1.2
-    :return: list of SentenceConversion objects
+    :param policy: combination policy, see get_change_combinations
+    :param max_combinations: maximum number of combinations per sentence, None for no maximum
+    :return: generator of SentenceConversion objects
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
-    words = [line[1] for line in lines] + [line[2] for line in lines]
-
-    samples = []
-    for sent in tqdm(conll, total=len(conll)):
+    for sent in conll:
         changes = []
         for tok in sent:
             if tok.upos != "NOUN" or 'Gender' not in tok.feats or len(tok.feats['Gender']) != 1:
                 continue
             is_masc = next(iter(tok.feats['Gender'])) == 'Masc'
-            if tok.lemma in words:
+            if tok.lemma in lexicon:
                 try:
-                    convert = get_fem_word(tok.lemma, lines) if is_masc else get_masc_word(tok.lemma, lines)
+                    convert = lexicon.get_counterpart(tok.lemma, is_masc)
                 except ValueError:
                     continue
                 changes.append((int(tok.id), convert, convert, not is_masc))
-        changes_list = []
-        for r in range(1, len(changes) + 1):
-            changes_list.extend(combinations(changes, r))
-        for change in changes_list:
-            samples.append(SentenceConversion(deepcopy(sent), change, use_v1, hack_v2))
-    return samples
+        for change in get_change_combinations(changes, policy, max_combinations, sent.id or ""):
+            yield SentenceConversion(sent, change, use_v1, hack_v2)
 
 
-def get_animate_sentences(conll, animate_file):
+def get_animate_samples(conll, lexicon, use_v1, hack_v2, policy="all", max_combinations=None):
     """
     :param conll: conll object
-    :param animate_file: file containing animate noun pairs
-    :return: list of tab separated conversion sentence entries
+    :param lexicon: AnimacyLexicon of animate noun pairs
+    :param use_v1: True if sentence is annotated using UD V1.2
+    :param hack_v2: True if sentence should be made into UD V2 from V1.2
+    :param policy: combination policy, see get_change_combinations
+    :param max_combinations: maximum number of combinations per sentence, None for no maximum
+    :return: list of SentenceConversion objects
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
-    words = [line[1] for line in lines] + [line[2] for line in lines]
+    return list(iter_animate_samples(tqdm(conll, total=len(conll)), lexicon, use_v1, hack_v2, policy,
+                                     max_combinations))
 
+
+def get_animate_sentences(conll, lexicon):
+    """
+    :param conll: conll object
+    :param lexicon: AnimacyLexicon of animate noun pairs
+    :return: list of tab separated conversion sentence entries
+    """
     conversion = []
     for sent in conll:
         for tok in sent:
-            if tok.lemma in words and tok.upos == "NOUN" and 'Gender' in tok.feats and len(tok.feats['Gender']) == 1:
+            if tok.lemma in lexicon and tok.upos == "NOUN" and 'Gender' in tok.feats and len(tok.feats['Gender']) == 1:
                 gender = next(iter(tok.feats['Gender']))
                 try:
-                    convert = get_fem_word(tok.lemma, lines) if gender == 'Masc' else get_masc_word(tok.lemma, lines)
+                    convert = lexicon.get_counterpart(tok.lemma, gender == 'Masc')
                 except ValueError:
                     continue
                 conversion.append("\t".join([sent.id, tok.id, tok.lemma, convert, get_sentence_text(sent)]) + "\n")
@@ -94,9 +117,7 @@ def write_heb_queries(animate_file, out_file):
     :param animate_file: file containing animate nouns
     :param out_file: output file
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
+    lines = load_lexicon(animate_file).pairs
     adj_sg = [
         ["טוב", "טובה"],
         ["רע", "רעה"],
@@ -156,9 +177,7 @@ def write_spanish_queries(animate_file, out_file):
     :param animate_file: file containing animate nouns
     :param out_file: output file
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
+    lines = load_lexicon(animate_file).pairs
     queries = ""
     adj_sg = [
         ["bueno", "buena"],
@@ -197,9 +216,7 @@ def write_french_queries(animate_file, out_file):
     :param animate_file: file containing animate nouns
     :param out_file: output file
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
+    lines = load_lexicon(animate_file).pairs
     queries = ""
     adj_sg = [
         ["bon", "bonne"],
@@ -256,9 +273,7 @@ def write_italian_queries(animate_file, out_file):
     :param animate_file: file containing animate nouns
     :param out_file: output file
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
+    lines = load_lexicon(animate_file).pairs
     queries = ""
     adj_sg = [
         ["buono", "buona"],
@@ -304,9 +319,7 @@ def write_russian_queries(animate_file, out_file):
     :param animate_file: file containing animate nouns
     :param out_file: output file
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
+    lines = load_lexicon(animate_file).pairs
     print(len(lines))
     queries = ""
     adj_sg = [
@@ -354,9 +367,7 @@ def write_polish_queries(animate_file, out_file):
     :param animate_file: file containing animate nouns
     :param out_file: output file
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
+    lines = load_lexicon(animate_file).pairs
     queries = ""
     adj_sg = [
         ["Dobry", "Dobra"],
@@ -411,9 +422,7 @@ def write_german_queries(animate_file, out_file):
     :param animate_file: file containing animate nouns
     :param out_file: output file
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
+    lines = load_lexicon(animate_file).pairs
     queries = ""
     adj_sg = ["gute", "schlechte", "schlaue", "schöne"]
     det = ["Der", "Die"]
@@ -1,6 +1,6 @@
 import torch as tr
 from utils.tree import *
-from utils.math import logsumexp, logmatmul, maxmul, logsumexp_col, logsumexp_mat
+from utils.kernels import logsumexp, logmatmul, maxmul, logsumexp_index
 
 """
 Messages are indexed by (msg_type, i, j) tuples.
@@ -144,7 +144,7 @@ def _pass_msg_fac(msgs, msg_type, i, j, pos1, pos2, lab, head, psi, phi, use_log
         elif use_log:
             msg = logmatmul(ms[0], psi[pos1, pos2, lab, :, :])
         else:
-            msg = tr.dot(ms[0], psi[pos1, pos2, lab, :, :])
+            msg = tr.matmul(ms[0], psi[pos1, pos2, lab, :, :])
     else:
         raise ValueError("Message must be to a variable from a unary factor (U_V) or a binary factor (B_V)")
     msgs[(msg_type, i, j)] = msg
@@ -234,10 +234,8 @@ def belief_propagation(T, pos, psi, phi, use_log=True):
     :param use_log: True if operations should be done in log space, False otherwise
     :return: messages of nodes in the factor graph of the tree
     """
-    # Check that tree is actually a tree
-    is_tree, err = validate_tree(T)
-    if not is_tree:
-        raise ValueError(err)
+    # Compiling the tree checks that it is actually a tree
+    T = as_tree(T, pos)
     msgs = dict()
     # Forward step
     msgs = _pass_msgs_from_leaves(T, pos, msgs, psi, phi, use_log, False)[0]
@@ -258,10 +256,8 @@ def max_product(T, pos, psi, phi, use_log=True):
     :param use_log: True if operations should be done in log space, False otherwise
     :return: messages of nodes in the factor graph of the tree and backpointers to best tags
     """
-    # Check that tree is actually a tree
-    is_tree, err = validate_tree(T)
-    if not is_tree:
-        raise ValueError(err)
+    # Compiling the tree checks that it is actually a tree
+    T = as_tree(T, pos)
     msgs = dict()
     pointers = dict()
     # Forward step
@@ -353,15 +349,51 @@ def calculate_psi_margin(msgs, T, pos, pos1, pos2, lab, psi, normalize, use_log=
             if use_log:
                 ms.append(logmatmul(tr.sum(mis, 0).view(len(mis[0]), 1), tr.sum(mjs, 0).view(1, len(mjs[0]))))
             else:
-                ms.append(tr.dot(tr.prod(mis, 0).view(len(mis[0]), 1), tr.prod(mjs, 0).view(1, len(mjs[0]))))
+                ms.append(tr.matmul(tr.prod(mis, 0).view(len(mis[0]), 1), tr.prod(mjs, 0).view(1, len(mjs[0]))))
     ms = tr.stack(ms)
     if use_log:
-        marg = psi[pos1, pos2, lab, :, :] + logsumexp_mat(ms) - normalize
+        marg = psi[pos1, pos2, lab, :, :] + logsumexp(ms, 0) - normalize
     else:
         marg = psi[pos1, pos2, lab, :, :] * tr.sum(ms, 0) / normalize
     return marg
 
 
+def _msgs_to_vars(msgs):
+    """
+    Index the messages to variable nodes by their destination, so that they do not have to be searched for
+    :param msgs: messages
+    :return: dictionary from each variable node to a dictionary from (msg_type, source node) to message
+    """
+    msgs_to = dict()
+    for (msg_type, i, j), msg in msgs.items():
+        if not _from_var(msg_type):
+            msgs_to.setdefault(j, dict())[(msg_type, i)] = msg
+    return msgs_to
+
+
+def calculate_edge_margins(msgs, T, use_log=True):
+    """
+    Calculate the (unnormalized) marginal distributions of the tags of both ends of all edges of a tree at once,
+    without their psi potentials
+    :param msgs: messages
+    :param T: tree
+    :param use_log: True if operations should be done in log space, False otherwise
+    :return: edges (i, j, lab) with a label, tensor of marginals of the tags of i and j of each edge
+    """
+    msgs_to = _msgs_to_vars(msgs)
+    edges = [(i, j, lab) for i, j, lab in T if lab != 0]
+    # Messages to i and to j from everything but the factor between i and j
+    mis = [[msg for key, msg in msgs_to[i].items() if key != (B_V, i)] for i, _, _ in edges]
+    mjs = [[msg for key, msg in msgs_to[j].items() if key != (B_V, i)] for i, j, _ in edges]
+    if use_log:
+        mis = tr.stack([tr.sum(tr.stack(ms), 0) for ms in mis])
+        mjs = tr.stack([tr.sum(tr.stack(ms), 0) for ms in mjs])
+        return edges, mis.unsqueeze(2) + mjs.unsqueeze(1)
+    mis = tr.stack([tr.prod(tr.stack(ms), 0) for ms in mis])
+    mjs = tr.stack([tr.prod(tr.stack(ms), 0) for ms in mjs])
+    return edges, mis.unsqueeze(2) * mjs.unsqueeze(1)
+
+
 def calculate_gradient(msgs, T, pos, psi, use_log=True, take_exp=True):
     """
     Calculate the marginals of the psi and phi parameters
@@ -375,15 +407,18 @@ def calculate_gradient(msgs, T, pos, psi, use_log=True, take_exp=True):
     :return: psi marginals, phi marginals
     """
     dpsi = tr.zeros_like(psi)
-    psi_calculated = set()
     normalize = calculate_belief_sum(msgs, use_log)
-    for i, j, lab in T:
-        if lab == 0:
-            continue
-        pos1 = pos[i - 1]
-        pos2 = pos[j - 1]
-        if (pos1, pos2, lab) not in psi_calculated:
-            psi_marg = calculate_psi_margin(msgs, T, pos, pos1, pos2, lab, psi, normalize, use_log)
-            dpsi[pos1, pos2, lab, :, :] = tr.exp(psi_marg) if take_exp else psi_marg
-            psi_calculated.add((pos1, pos2, lab))
+    edges, ms = calculate_edge_margins(msgs, T, use_log)
+    if not edges:
+        return dpsi
+    # Edges sharing a factor are summed into the same psi entry
+    factors = tr.tensor([(pos[i - 1], pos[j - 1], lab) for i, j, lab in edges])
+    factors, index = tr.unique(factors, dim=0, return_inverse=True)
+    pos1, pos2, lab = factors.t()
+    if use_log:
+        psi_marg = psi[pos1, pos2, lab, :, :] + logsumexp_index(ms, index, len(factors)) - normalize
+        dpsi[pos1, pos2, lab, :, :] = tr.exp(psi_marg) if take_exp else psi_marg
+    else:
+        ms = tr.zeros((len(factors),) + ms.shape[1:], dtype=ms.dtype).index_add_(0, index, ms)
+        dpsi[pos1, pos2, lab, :, :] = psi[pos1, pos2, lab, :, :] * ms / normalize
     return dpsi
@@ -1,5 +1,5 @@
 import argparse
-from utils.conll import load_sentences
+from utils.conll import load_partitions
 from utils.data import get_sentence_text
 from tqdm import tqdm
 import os
@@ -21,21 +21,21 @@ if __name__ == '__main__':
         out = open(out_file, "w")
         print("Processing file " + str(i + 1) + " out of " + str(len(opt.in_files)) + " files")
         part = 1
-        with open(file, "r") as f:
-            not_empty = True
-            while not_empty and (not opt.part or part <= opt.part):
+        with open(file, "rb") as f:
+            for conll, _ in load_partitions(f, 10000):
+                if opt.part and part > opt.part:
+                    break
                 print("  Partition", part)
-                conll, not_empty = load_sentences(10000, f)
-                out_text = ""
+                out_text = []
                 for sent in tqdm(conll, total=len(conll)):
                     try:
-                        out_text += get_sentence_text(sent) + "\n"
+                        out_text.append(get_sentence_text(sent) + "\n")
                     except TypeError:
                         for x in sent:
                             print(x.id, x.form, x.lemma, x.upos, x.head, x.deprel)
                         exit()
                 del conll
-                out.write(out_text)
+                out.write("".join(out_text))
                 del out_text
                 part += 1
         out.close()
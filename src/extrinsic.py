@@ -1,6 +1,8 @@
 import pickle
 from tqdm import tqdm
 import numpy as np
+from collections import Counter
+from utils.lexicon import load_lexicon
 
 
 def save_stereotypes(animate_file, text_file, out_file):
@@ -10,19 +12,15 @@ def save_stereotypes(animate_file, text_file, out_file):
     :param text_file: file to test words counts on
     :param out_file: output file
     """
-    with open(animate_file, "r") as f:
-        lines = f.readlines()
-    lines = [line.strip().split("\t") for line in lines]
-    words = list(zip([line[1] for line in lines], [line[2] for line in lines]))
+    words = [(fem, masc) for _, fem, masc in load_lexicon(animate_file).pairs]
     with open(text_file) as f:
-        text = f.read()
-    text = text.split()
+        counts = Counter(f.read().split())
     fem_main = []
     masc_main = []
     for i in tqdm(range(len(words)), total=len(words)):
         fem, masc = words[i]
-        fem_count = text.count(fem) + text.count(fem.capitalize())
-        masc_count = text.count(masc) + text.count(masc.capitalize())
+        fem_count = counts[fem] + counts[fem.capitalize()]
+        masc_count = counts[masc] + counts[masc.capitalize()]
         if .25 * fem_count >= masc_count and fem_count != 0:
             fem_main.append((i, fem, masc))
         elif .25 * masc_count >= fem_count and masc_count != 0:
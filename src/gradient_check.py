@@ -0,0 +1,65 @@
+import argparse
+import random
+import torch
+from model import Model
+from mrf_op import MRFLoss
+from utils.data import Sentence
+from utils.gen_data import gen_psi, gen_tree
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trees', default=5, type=int, help='Number of random trees')
+    parser.add_argument('--max_len', default=5, type=int, help='Maximum number of nodes of a tree')
+    parser.add_argument('--pos', default=2, type=int, help='Number of pos tags')
+    parser.add_argument('--labels', default=3, type=int, help='Number of dependency labels')
+    parser.add_argument('--tol', default=1e-6, type=float, help='Absolute tolerance')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed')
+    return parser.parse_args()
+
+
+def check_gradients(model, T, pos, m, psi, tol):
+    """
+    Check that the autograd gradients of MRFLoss wrt psi and phi match -Model.dlog_prob and the finite difference
+    gradients of Model.fd_grad
+
+    :param model: Model
+    :param T: tree
+    :param pos: list of pos tags
+    :param m: list of tags
+    :param psi: psi potentials
+    :param tol: absolute tolerance
+    """
+    psi = psi.clone().requires_grad_()
+    phi = model.create_phi(T, pos, m).requires_grad_()
+    MRFLoss(model, [Sentence(T, pos, m)])(psi, [phi]).backward()
+
+    # -log Pr(m|T) = logZ - log_score, and the log score is linear in psi and phi
+    dpsi = -model.dlog_prob(T, pos, m, psi.detach().clone(), phi.detach().clone())
+    fd_dpsi, fd_dphi = model.fd_grad(T, pos, psi.detach().clone(), phi.detach().clone())
+    dpsi_score = model.dlog_score(T, pos, m, psi.detach())
+    dphi_score = model.create_phi(T, pos, m)
+    assert torch.allclose(psi.grad, dpsi, atol=tol), "psi gradient differs from Model.dlog_prob"
+    assert torch.allclose(psi.grad, fd_dpsi - dpsi_score, atol=tol), "psi gradient differs from Model.fd_grad"
+    assert torch.allclose(phi.grad, fd_dphi - dphi_score, atol=tol), "phi gradient differs from Model.fd_grad"
+
+
+def main():
+    """
+    Program to check the gradients of MRFLoss on random trees
+    """
+    opt = get_args()
+    random.seed(opt.seed)
+    torch.manual_seed(opt.seed)
+    model = Model([0, 1, 2])
+    for _ in range(opt.trees):
+        n = random.randint(2, opt.max_len)
+        T = gen_tree(n, opt.labels)
+        pos = [random.randrange(opt.pos) for _ in range(n)]
+        m = [random.choice(model.get_tags()) for _ in range(n)]
+        check_gradients(model, T, pos, m, gen_psi(opt.pos, opt.labels, model.tag_size()), opt.tol)
+    print("MRFLoss gradients match on", opt.trees, "random trees")
+
+
+if __name__ == '__main__':
+    main()
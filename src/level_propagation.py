@@ -0,0 +1,387 @@
+import torch as tr
+from collections import namedtuple
+from utils.tree import get_levels, as_tree
+from utils.kernels import logmatmul, logsumexp_index, maxmul
+
+"""
+Level-synchronous belief propagation for a tree.
+
+The tree is compiled once into levels of nodes of equal depth, and all messages of a level are computed with a single
+batched tensor operation. Messages are stored in dense [n, num_tags] tensors (row i - 1 belongs to node i) instead of a
+dictionary keyed by (msg_type, i, j):
+
+inside[i] is the sum of all messages to variable i from below, i.e. from its unary factor and from the binary factors
+of its children (V_B in belief_propagation.py)
+up[i] is the message from the binary factor between i and its head to the head (B_V, i, head)
+down[i] is the message from the binary factor between i and its head to i (B_V, i, i), it is 0 for the root
+
+Several sentences can be processed at once by packing them into a TreeBatch. Sentence b is padded to the length of the
+longest sentence, size, and node i of sentence b is stored in row b * size + i - 1 of the message tensors. Levels of
+equal depth of all sentences are merged, so a batch needs as many batched operations as its deepest tree. A single
+tree is a batch of size one, so its messages are laid out exactly as described above.
+
+phi, and hence all messages, can have leading dimensions before the node dimension, e.g. [num_combinations, n,
+num_tags] to decode several phi potentials of the same trees in a single pass.
+
+All operations are done in log space and only use out-of-place tensor operations, so results can be differentiated
+with autograd.
+"""
+
+Messages = namedtuple('Messages', 'inside up down')
+Level = namedtuple('Level', 'nodes heads pos1 pos2 labs')
+TreeBatch = namedtuple('TreeBatch', 'heads pos labels mask levels roots')
+
+
+def pack_trees(trees, pos):
+    """
+    Pack a list of trees into padded tensors
+
+    :param trees: list of trees
+    :param pos: list of pos tag lists
+    :return: TreeBatch with padded [batch_size, size] tensors of heads (0-indexed, -1 for the root and padding), pos
+    tags, labels and a mask of real nodes, the merged levels (excluding the roots) from the roots to the leaves with
+    flat node indices and the flat indices of the roots
+    """
+    size = max(len(T) for T in trees)
+    heads = tr.full((len(trees), size), -1, dtype=tr.long)
+    pos_tags = tr.zeros((len(trees), size), dtype=tr.long)
+    labels = tr.zeros((len(trees), size), dtype=tr.long)
+    mask = tr.zeros((len(trees), size), dtype=tr.bool)
+    levels, roots = [], []
+    for b in range(len(trees)):
+        T, p = trees[b], pos[b]
+        tree_heads, tree_labels, tree_levels = get_levels(T)
+        offset = b * size
+        roots.append(offset + tree_levels[0][0] - 1)
+        for d in range(1, len(tree_levels)):
+            if len(levels) < d:
+                levels.append(([], [], [], [], []))
+            nodes, level_heads, pos1, pos2, labs = levels[d - 1]
+            for i in tree_levels[d]:
+                j = tree_heads[i - 1]
+                nodes.append(offset + i - 1)
+                level_heads.append(offset + j - 1)
+                pos1.append(p[i - 1])
+                pos2.append(p[j - 1])
+                labs.append(tree_labels[i - 1])
+        heads[b, :len(T)] = tr.tensor(tree_heads) - 1
+        pos_tags[b, :len(T)] = tr.tensor(p)
+        labels[b, :len(T)] = tr.tensor(tree_labels)
+        mask[b, :len(T)] = True
+    levels = [Level(*[tr.tensor(x) for x in level]) for level in levels]
+    return TreeBatch(heads, pos_tags, labels, mask, levels, tr.tensor(roots))
+
+
+def pack_phi(phis, batch):
+    """
+    :param phis: list of unary phi potentials of dimension [n_b, num_tags]
+    :param batch: TreeBatch
+    :return: flat padded phi potentials of dimension [batch_size * size, num_tags]
+    """
+    batch_size, size = batch.mask.shape
+    phi = tr.zeros((batch_size, size, phis[0].shape[1]), dtype=phis[0].dtype)
+    for b in range(batch_size):
+        phi[b, :len(phis[b])] = phis[b]
+    return phi.view(batch_size * size, -1)
+
+
+def _pass_msgs_up(levels, psi, phi, max_product):
+    """
+    Message passing from leaves to root
+
+    :param levels: compiled levels of the trees
+    :param psi: binary psi potentials
+    :param phi: unary phi potentials of dimension [..., n, num_tags]
+    :param max_product: True if using max-product, False otherwise (sum-product)
+    :return: inside messages, up messages, back pointers (None if max_product=False)
+    """
+    inside = phi
+    up = tr.zeros_like(phi)
+    pointers = tr.zeros(phi.shape, dtype=tr.long) if max_product else None
+    for level in reversed(levels):
+        # msg[k, b] combines inside[node_k, a] + psi(a, b) over the tags a of node_k, b is the tag of its head
+        node_msg = inside[..., level.nodes, :].unsqueeze(-2)
+        level_psi = psi[level.pos1, level.pos2, level.labs]
+        if max_product:
+            msg, pointer = maxmul(node_msg, level_psi)
+            msg, pointer = msg.squeeze(-2), pointer.squeeze(-2)
+            pointers[..., level.nodes, :] = pointer
+        else:
+            msg = logmatmul(node_msg, level_psi).squeeze(-2)
+        up = up.index_copy(-2, level.nodes, msg)
+        inside = inside.index_add(-2, level.heads, msg)
+    return inside, up, pointers
+
+
+def _pass_msgs_down(levels, psi, inside, up):
+    """
+    Message passing from root to leaves
+
+    :param levels: compiled levels of the trees
+    :param psi: binary psi potentials
+    :param inside: inside messages
+    :param up: up messages
+    :return: down messages
+    """
+    down = tr.zeros_like(inside)
+    for level in levels:
+        # Everything the head has received except the message from the factor of the current node
+        head_msg = inside[..., level.heads, :] + down[..., level.heads, :] - up[..., level.nodes, :]
+        msg = logmatmul(psi[level.pos1, level.pos2, level.labs], head_msg.unsqueeze(-1)).squeeze(-1)
+        down = down.index_copy(-2, level.nodes, msg)
+    return down
+
+
+def belief_propagation_batch(batch, psi, phi):
+    """
+    Belief propagation algorithm for a batch of trees
+
+    :param batch: TreeBatch
+    :param psi: binary psi potentials
+    :param phi: flat padded unary phi potentials of dimension [..., batch_size * size, num_tags]
+    :return: messages of nodes in the factor graphs of the trees
+    """
+    inside, up, _ = _pass_msgs_up(batch.levels, psi, phi, False)
+    down = _pass_msgs_down(batch.levels, psi, inside, up)
+    return Messages(inside, up, down)
+
+
+def belief_propagation(T, pos, psi, phi):
+    """
+    Belief propagation algorithm for a tree
+
+    :param T: tree
+    :param pos: list of pos tags
+    :param psi: binary psi potentials
+    :param phi: unary phi potentials
+    :return: messages of nodes in the factor graph of the tree
+    """
+    return belief_propagation_batch(pack_trees([T], [pos]), psi, phi)
+
+
+def max_product_batch(batch, psi, phi):
+    """
+    Max-Product algorithm for a batch of trees. Only the upward pass is needed to find the best tags, so down messages
+    are not computed
+
+    :param batch: TreeBatch
+    :param psi: binary psi potentials
+    :param phi: flat padded unary phi potentials of dimension [..., batch_size * size, num_tags]
+    :return: messages of nodes in the factor graphs of the trees and backpointers to best tags
+    """
+    inside, up, pointers = _pass_msgs_up(batch.levels, psi, phi, True)
+    return Messages(inside, up, None), pointers
+
+
+def max_product(T, pos, psi, phi):
+    """
+    Max-Product algorithm for a tree. Only the upward pass is needed to find the best tags, so down messages are not
+    computed
+
+    :param T: tree
+    :param pos: list of pos tags
+    :param psi: binary psi potentials
+    :param phi: unary phi potentials
+    :return: messages of nodes in the factor graph of the tree and backpointers to best tags
+    """
+    return max_product_batch(pack_trees([T], [pos]), psi, phi)
+
+
+def marg_dist(msgs, i):
+    """
+    Calculate the (log) marginal distribution of a variable node from the messages of a factor graph
+
+    :param msgs: messages
+    :param i: node
+    :return: marginal distribution of variable node i
+    """
+    return msgs.inside[i - 1] + msgs.down[i - 1]
+
+
+def marginals(msgs):
+    """
+    :param msgs: messages
+    :return: (log) marginal distributions of all variable nodes, row i - 1 belongs to node i
+    """
+    return msgs.inside + msgs.down
+
+
+def calculate_belief_sum(msgs):
+    """
+    Calculate the (log) sum of the beliefs for a variable in a factor graph. This value is the same for all variable
+    nodes
+
+    :param msgs: messages
+    :return: Sum of belief or marginals of any variable node
+    """
+    return tr.logsumexp(marg_dist(msgs, 1), 0)
+
+
+def calculate_belief_sums(batch, msgs):
+    """
+    :param batch: TreeBatch
+    :param msgs: messages
+    :return: (log) sum of the beliefs of each tree in the batch
+    """
+    return tr.logsumexp(msgs.inside[..., batch.roots, :], -1)
+
+
+def get_best_tags(T, msgs, pointers):
+    """
+    Find the best tag sequence for a tree
+
+    :param T: tree, list of edges or DependencyTree
+    :param msgs: messages
+    :param pointers: back pointers
+    :return: tensor containing the best tag for each node in the tree, entry i - 1 belongs to node i
+    """
+    heads, _, levels = get_levels(T)
+    root = levels[0][0]
+    tags = tr.zeros(len(T), dtype=tr.long)
+    tags[root - 1] = tr.argmax(msgs.inside[root - 1])
+    for level in levels[1:]:
+        nodes = tr.tensor([i - 1 for i in level])
+        level_heads = tr.tensor([heads[i - 1] - 1 for i in level])
+        tags[nodes] = pointers[nodes, tags[level_heads]]
+    return tags
+
+
+def get_best_tags_batch(batch, msgs, pointers):
+    """
+    Find the best tag sequences for a batch of trees
+
+    :param batch: TreeBatch
+    :param msgs: messages
+    :param pointers: back pointers
+    :return: [..., batch_size, size] tensor containing the best tag for each node, padding is tagged 0
+    """
+    tags = tr.zeros(pointers.shape[:-1], dtype=tr.long)
+    tags[..., batch.roots] = tr.argmax(msgs.inside[..., batch.roots, :], -1)
+    for level in batch.levels:
+        head_tags = tags[..., level.heads].unsqueeze(-1)
+        tags[..., level.nodes] = pointers[..., level.nodes, :].gather(-1, head_tags).squeeze(-1)
+    return tags.view(tags.shape[:-1] + batch.mask.shape)
+
+
+class IncrementalMaxProduct:
+    """
+    Max-Product for a tree whose phi potentials change at a few nodes at a time, e.g. to clamp the tags of some nodes.
+    The messages of the tree are computed once. When phi changes at a set of nodes, only the messages on the paths
+    from these nodes to the root are recomputed, and the best tags are only traced again below the nodes whose tag or
+    back pointers changed. Messages are recomputed with the same operations in the same order as max_product, so the
+    best tags are the same as those of a full pass
+    """
+    def __init__(self, T, pos, psi, phi):
+        """
+        :param T: tree
+        :param pos: list of pos tags
+        :param psi: binary psi potentials
+        :param phi: unary phi potentials
+        """
+        self.tree = as_tree(T, pos)
+        batch = pack_trees([self.tree], [pos])
+        msgs, pointers = max_product_batch(batch, psi, phi)
+        # Copies, so that keeping updates never writes to tensors shared with the caller
+        self.phi = phi.clone()
+        self.inside = msgs.inside.clone()
+        self.up = msgs.up.clone()
+        self.pointers = pointers.tolist()
+        self.tags = get_best_tags_batch(batch, msgs, pointers)[0].tolist()
+        # psi of the edge from each node to its head, the row of the root is never used
+        heads = tr.tensor(self.tree.heads) - 1
+        pos = tr.tensor(pos)
+        self.edge_psi = psi[pos, pos[heads], tr.tensor(self.tree.labels)]
+
+    def best_tags(self, phi_updates=None, keep=False):
+        """
+        Find the best tag sequence of the tree after replacing some rows of phi
+
+        :param phi_updates: dictionary from node i to its new phi potentials phi[i - 1]
+        :param keep: True if the updated phi and messages replace the stored ones, False if they only apply to this
+        call
+        :return: list containing the best tag for each node in the tree, entry i - 1 belongs to node i
+        """
+        tree = self.tree
+        if not phi_updates:
+            return list(self.tags)
+        path = set()
+        for i in phi_updates:
+            if not 1 <= i <= len(tree):
+                raise ValueError(str(i) + " must be an index of the tree (0 < i <= " + str(len(tree)) + ")")
+            while i != 0 and i not in path:
+                path.add(i)
+                i = tree.heads[i - 1]
+        # Messages on the paths, from the deepest nodes up to the root
+        inside, up, pointers = {}, {}, {}
+        for i in sorted(path, key=lambda i: -tree.depth[i - 1]):
+            msg = phi_updates[i] if i in phi_updates else self.phi[i - 1]
+            for k, _ in tree.children(i):
+                msg = msg + (up[k] if k in up else self.up[k - 1])
+            inside[i] = msg
+            if i != tree.root:
+                up[i], pointer = maxmul(msg, self.edge_psi[i - 1])
+                pointers[i] = pointer.tolist()
+        # Only the children of nodes whose tag changed and the nodes on the paths can change their tag
+        tags = list(self.tags)
+        tags[tree.root - 1] = int(tr.argmax(inside[tree.root]))
+        stack = [tree.root]
+        while stack:
+            j = stack.pop()
+            changed = tags[j - 1] != self.tags[j - 1]
+            for k, _ in tree.children(j):
+                if changed or k in path:
+                    tags[k - 1] = (pointers[k] if k in pointers else self.pointers[k - 1])[tags[j - 1]]
+                    stack.append(k)
+        if keep:
+            for i in phi_updates:
+                self.phi[i - 1] = phi_updates[i]
+            for i in inside:
+                self.inside[i - 1] = inside[i]
+            for i in up:
+                self.up[i - 1] = up[i]
+                self.pointers[i - 1] = pointers[i]
+            self.tags = tags
+        return tags
+
+
+def calculate_gradient_batch(msgs, batch, psi, take_exp=True):
+    """
+    Calculate the marginals of the psi parameters summed over a batch of trees
+
+    :param msgs: messages
+    :param batch: TreeBatch
+    :param psi: psi potentials
+    :param take_exp: True if marginals computed are log marginals, False otherwise
+    :return: psi marginals
+    """
+    dpsi = tr.zeros_like(psi)
+    if not batch.levels:
+        return dpsi
+    size = batch.mask.shape[1]
+    normalize = calculate_belief_sums(batch, msgs)
+    marg = marginals(msgs)
+    i, j, pos1, pos2, lab = [tr.cat(x) for x in zip(*batch.levels)]
+    is_edge = lab != 0
+    i, j, pos1, pos2, lab = i[is_edge], j[is_edge], pos1[is_edge], pos2[is_edge], lab[is_edge]
+    # Messages to i from below and to j from everything but the factor between i and j, for all edges at once
+    ms = msgs.inside[i].unsqueeze(2) + (marg[j] - msgs.up[i]).unsqueeze(1) - normalize[i // size].view(-1, 1, 1)
+    # Edges sharing a factor are summed into the same psi entry
+    factors, index = tr.unique(tr.stack((pos1, pos2, lab), 1), dim=0, return_inverse=True)
+    pos1, pos2, lab = factors.t()
+    psi_marg = psi[pos1, pos2, lab, :, :] + logsumexp_index(ms, index, len(factors))
+    dpsi[pos1, pos2, lab, :, :] = tr.exp(psi_marg) if take_exp else psi_marg
+    return dpsi
+
+
+def calculate_gradient(msgs, T, pos, psi, take_exp=True):
+    """
+    Calculate the marginals of the psi parameters
+
+    :param msgs: messages
+    :param T: tree
+    :param pos: list of pos tags
+    :param psi: psi potentials
+    :param take_exp: True if marginals computed are log marginals, False otherwise
+    :return: psi marginals
+    """
+    return calculate_gradient_batch(msgs, pack_trees([T], [pos]), psi, take_exp)
@@ -1,10 +1,16 @@
 import argparse
-from animacy import get_animate_samples
+import os
+from itertools import islice
+from animacy import iter_animate_samples
 from model import Model
+from SentenceConversion import apply_batch
+from sigmorphon_reinflection.cache import ReinflectionCache, model_checksum
 from sigmorphon_reinflection.decode import get_decoding_model
+from sigmorphon_reinflection.table import ReinflectionTable
 from sigmorphon_reinflection.reinflection_model import *
 from tqdm import tqdm
-from utils.conll import load_sentences
+from utils.conll import load_partitions
+from utils.lexicon import load_lexicon
 
 def get_args():
     """
@@ -16,12 +22,39 @@ def get_args():
     parser.add_argument('--psi', required=True, help='Path to psi parameters')
     parser.add_argument('--reinflect', required=True, help='Path to reinflection model')
     parser.add_argument('--animate_list', required=True, help='Path to animate noun list')
+    parser.add_argument('--lowercase', default=False, action='store_true',
+                        help='Match lemmas against the animate noun list case-insensitively')
+    parser.add_argument('--normalization', choices=['NFC', 'NFD', 'NFKC', 'NFKD'],
+                        help='Unicode normalization used to match lemmas against the animate noun list')
+    parser.add_argument('--combinations', default='all', choices=['all', 'singletons', 'all_at_once'],
+                        help='Combinations of animate nouns to convert per sentence')
+    parser.add_argument('--max_combinations', type=int,
+                        help='Maximum number of conversions per sentence, combinations are sampled deterministically')
+    parser.add_argument('--reinflection_cache', help='sqlite file to store reinflections in across runs')
+    parser.add_argument('--reinflection_table', help='Reinflection table built with reinflection_table.py')
+    parser.add_argument('--cache_size', default=100000, type=int, help='Number of reinflections cached in memory')
+    parser.add_argument('--batch_size', default=1000, type=int,
+                        help='Number of conversions whose MRF decoding and reinflections are done at once')
+    parser.add_argument('--reinflection_batch_size', default=256, type=int,
+                        help='Number of words reinflected at once')
+    parser.add_argument('--quantize', default=False, action='store_true',
+                        help='Quantize the reinflection model to int8 and run it on CPU')
     parser.add_argument('--inc_input', default=False, action='store_true', help='True if input should be copied into output file')
     parser.add_argument('--use_v1', default=False, action='store_true')
     parser.add_argument('--hack_v2', default=False, action='store_true')
     parser.add_argument('--get_ids', default=False, action='store_true')
     parser.add_argument('--part', type=int)
-    return parser.parse_args()
+    parser.add_argument('--offset', default=0, type=int, help='Byte offset in the --start_file file to resume from')
+    parser.add_argument('--start_file', default=0, type=int,
+                        help='Index of the input file to resume from, earlier input files are skipped')
+    opt = parser.parse_args()
+    if opt.offset < 0:
+        parser.error("--offset cannot be negative")
+    if opt.max_combinations is not None and opt.max_combinations < 0:
+        parser.error("--max_combinations cannot be negative")
+    if not 0 <= opt.start_file < len(opt.in_files):
+        parser.error("--start_file must be the index of one of the --in_files")
+    return opt
 
 
 def main():
@@ -35,53 +68,66 @@ def main():
     psi = torch.load(opt.psi)
     print(psi.shape)
     with torch.no_grad():
-        reinflection_model, device, decode_fn, decode_trg = get_decoding_model(opt.reinflect)
+        reinflection_model, device, decode_fn, decode_trg = get_decoding_model(opt.reinflect, quantize=opt.quantize)
     print("Models loaded")
 
-    out = open(opt.out_file, "w")
+    # Quantized models can reinflect differently, so they do not share cached forms with the float model
+    checksum = model_checksum(opt.reinflect) + ("-int8" if opt.quantize else "")
+    table = ReinflectionTable(opt.reinflection_table) if opt.reinflection_table else None
+    cache = ReinflectionCache(checksum, opt.cache_size, opt.reinflection_cache, table)
+    lexicon = load_lexicon(opt.animate_list, opt.lowercase, opt.normalization)
+    # Append to the output of the earlier run when resuming
+    out = open(opt.out_file, "a" if opt.offset > 0 or opt.start_file > 0 else "w")
     if not isinstance(opt.in_files, list):
         opt.in_files = [opt.in_files]
     count = 0
     # Find and convert sentences with animate nouns for each file
-    for i in range(len(opt.in_files)):
+    for i in range(opt.start_file, len(opt.in_files)):
         file = opt.in_files[i]
         print("Processing file " + str(i + 1) + " out of " + str(len(opt.in_files)) + " files")
         part = 1
-        with open(file, "r") as f:
-            # line = f.readline()
-            # Work in batches of 100,000 sentences to avoid memory issues
-            not_empty = True
-            while not_empty:
+        # Resume from a byte offset reported by an earlier run, the following files are read from the start
+        offset = opt.offset if i == opt.start_file else 0
+        with open(file, "rb") as f:
+            f.seek(offset)
+            # Work in partitions of 10,000 sentences to avoid memory issues
+            for conll, offset in load_partitions(f, 10000, offset):
                 print("  Partition", part)
-                # Load sentences
-                print("    Loading partition...")
-                conll, not_empty = load_sentences(10000, f)
-                # Extract sentences with animate nouns
-                print("    Finding animate nouns...")
-                samples = get_animate_samples(conll, opt.animate_list, opt.use_v1, opt.hack_v2)
+                # Conversions of sentences with animate nouns are generated lazily while converting
+                samples = iter_animate_samples(conll, lexicon, opt.use_v1, opt.hack_v2, opt.combinations,
+                                               opt.max_combinations)
                 if opt.inc_input:
                     out.write(conll.conll())
                 del conll
-                print("     ", str(len(samples)), "animate nouns found")
 
                 # Convert gender of sentences
                 converted_sentences = []
-                print("    Converting sentences...")
-                for sc in tqdm(samples, total=len(samples)):
-                    try:
-                        converted = sc.apply(model, psi, reinflection_model, device, decode_fn, decode_trg)
-                        converted_sentences.append(converted)
-                    except ValueError:
-                        continue
-                    except IndexError:
-                        continue
+                print("    Converting sentences with animate nouns...")
+                progress = tqdm()
+                # Batches of conversions are decoded with max-product together, then their reinflections are
+                # deduplicated and decoded in batches
+                batch = list(islice(samples, opt.batch_size))
+                while batch:
+                    converted = apply_batch(batch, model, psi, reinflection_model, device, decode_fn, decode_trg, cache,
+                                            opt.reinflection_batch_size)
+                    converted_sentences.extend(sentence for sentence in converted if sentence is not None)
+                    progress.update(len(batch))
+                    batch = list(islice(samples, opt.batch_size))
+                progress.close()
                 del samples
                 out.write("\n\n".join(converted_sentences) + "\n\n")
+                print("     ", str(len(converted_sentences)), "sentences converted")
                 del converted_sentences
+                cache.report()
+                # Make sure the partition is on disk before reporting where to resume from
+                out.flush()
+                os.fsync(out.fileno())
+                print("    Partition done, resume with --start_file", i, "--offset", offset)
                 part += 1
                 if opt.part and opt.part < part:
                     break
     out.close()
+    cache.close()
     print("Done")
 
 
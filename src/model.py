@@ -1,5 +1,6 @@
-from belief_propagation import belief_propagation, calculate_gradient, calculate_belief_sum,\
-    max_product, get_best_tags
+from level_propagation import belief_propagation, calculate_gradient, calculate_belief_sum,\
+    max_product, get_best_tags, pack_trees, pack_phi, belief_propagation_batch, calculate_belief_sums,\
+    calculate_gradient_batch, max_product_batch, get_best_tags_batch, IncrementalMaxProduct
 from itertools import product
 from utils.math import logsumexp
 import torch as tr
@@ -100,7 +101,7 @@ class Model(object):
         """
         Calculate the (log) agreement of a list of tags for a given tree
 
-        :param T: tree
+        :param T: tree, list of edges or DependencyTree
         :param pos: list of pos tags
         :param m: list of tags
         :param psi: psi potentials
@@ -122,7 +123,7 @@ class Model(object):
         """
         Calculate the gradient of the log score for a given tree with respect to the psi and phi parameters
 
-        :param T: Tree
+        :param T: tree, list of edges or DependencyTree
         :param pos: list of pos tags
         :param m: list of tags
         :param psi: psi potentials
@@ -148,8 +149,8 @@ class Model(object):
         :param phi: phi potentials
         :return: log(Z) where Z is the normalizing partition function for p(m|T)
         """
-        msgs = belief_propagation(T, pos, psi, phi, True)
-        log_z = calculate_belief_sum(msgs, True)
+        msgs = belief_propagation(T, pos, psi, phi)
+        log_z = calculate_belief_sum(msgs)
         return log_z
 
     def dlogZ(self, T, pos, psi, phi):
@@ -162,8 +163,8 @@ class Model(object):
         :param phi: phi potentials
         :return: dlog_Z/dlog_psi, dlog_Z/dlog_phi
         """
-        msgs = belief_propagation(T, pos, psi, phi, True)
-        dpsi = calculate_gradient(msgs, T, pos, psi, True, True)
+        msgs = belief_propagation(T, pos, psi, phi)
+        dpsi = calculate_gradient(msgs, T, pos, psi, True)
         return dpsi
 
     def log_prob(self, T, pos, m, psi, phi=tr.Tensor()):
@@ -216,13 +217,225 @@ class Model(object):
             phi[idx - 1, m] = 100
         # if fix_idx:
         #     phi[fix_idx - 1, fix_m] = 100
-        msgs, pointers = max_product(T, pos, psi, phi, True)
-        tags_dict = get_best_tags(T, msgs, pointers)
+        msgs, pointers = max_product(T, pos, psi, phi)
+        best_tags = get_best_tags(T, msgs, pointers)
         tags = []
-        for i in range(1, len(T) + 1):
-            tags.append(self.get_tag(tags_dict[str(i)]))
+        for idx in best_tags.tolist():
+            tags.append(self.get_tag(idx))
+        return tags
+
+    """
+    Batched inference over many trees
+    """
+    def pack_tags(self, batch, ms):
+        """
+        :param batch: TreeBatch
+        :param ms: list of tag sequences
+        :return: padded [batch_size, size] tensor of tag indices
+        """
+        tags = tr.zeros(batch.mask.shape, dtype=tr.long)
+        for b in range(len(ms)):
+            tags[b, :len(ms[b])] = tr.tensor([self.get_tag_index(m) for m in ms[b]])
         return tags
 
+    def log_score_batch(self, batch, tags, psi, phi):
+        """
+        Calculate the (log) agreement of the tags of a batch of trees
+
+        :param batch: TreeBatch
+        :param tags: padded tensor of tag indices
+        :param psi: psi potentials
+        :param phi: flat padded phi potentials
+        :return: (log) agreement of the tags of each tree
+        """
+        phi_score = phi.gather(1, tags.view(-1, 1)).view(tags.shape)
+        heads = batch.heads.clamp(min=0)
+        psi_score = psi[batch.pos, batch.pos.gather(1, heads), batch.labels, tags, tags.gather(1, heads)]
+        is_edge = batch.mask & (batch.heads >= 0)
+        return tr.where(batch.mask, phi_score, tr.zeros_like(phi_score)).sum(1) +\
+            tr.where(is_edge, psi_score, tr.zeros_like(psi_score)).sum(1)
+
+    def dlog_score_batch(self, batch, tags, psi):
+        """
+        Calculate the gradient of the log score summed over a batch of trees with respect to the psi parameters
+
+        :param batch: TreeBatch
+        :param tags: padded tensor of tag indices
+        :param psi: psi potentials
+        :return: dlog_score/dlog_psi
+        """
+        dpsi = tr.zeros_like(psi)
+        heads = batch.heads.clamp(min=0)
+        is_edge = batch.mask & (batch.heads >= 0)
+        idx = (batch.pos, batch.pos.gather(1, heads), batch.labels, tags, tags.gather(1, heads))
+        idx = tuple(x[is_edge] for x in idx)
+        return dpsi.index_put_(idx, tr.ones(len(idx[0]), dtype=psi.dtype), accumulate=True)
+
+    def create_phis(self, trees, pos, ms, alpha=1):
+        """
+        :param trees: list of trees
+        :param pos: list of pos sequences
+        :param ms: list of tag sequences
+        :return: list of phi factors of each tree
+        """
+        return [self.create_phi(T, p, m, alpha) for T, p, m in zip(trees, pos, ms)]
+
+    def logZ_batch(self, trees, pos, psi, phis):
+        """
+        Belief propagation algorithm for calculating the log of the partition function Z of many trees at once
+
+        :param trees: list of trees
+        :param pos: list of pos sequences
+        :param psi: psi potentials
+        :param phis: list of phi potentials
+        :return: tensor of log(Z) of each tree
+        """
+        batch = pack_trees(trees, pos)
+        msgs = belief_propagation_batch(batch, psi, pack_phi(phis, batch))
+        return calculate_belief_sums(batch, msgs)
+
+    def dlogZ_batch(self, trees, pos, psi, phis):
+        """
+        Belief propagation algorithm for calculating the gradient of the log of the partition function Z summed over
+        many trees
+
+        :param trees: list of trees
+        :param pos: list of pos sequences
+        :param psi: psi potentials
+        :param phis: list of phi potentials
+        :return: sum of dlog_Z/dlog_psi
+        """
+        batch = pack_trees(trees, pos)
+        msgs = belief_propagation_batch(batch, psi, pack_phi(phis, batch))
+        return calculate_gradient_batch(msgs, batch, psi, True)
+
+    def log_prob_batch(self, trees, pos, ms, psi, phis=None):
+        """
+        Calculate the conditional log probability of the tags given the tree for many trees at once
+
+        :param trees: list of trees
+        :param pos: list of pos sequences
+        :param ms: list of tag sequences
+        :param psi: psi potentials
+        :param phis: list of phi potentials
+        :return: tensor of log(p(m|T)) of each tree
+        """
+        if phis is None:
+            phis = self.create_phis(trees, pos, ms)
+        batch = pack_trees(trees, pos)
+        phi = pack_phi(phis, batch)
+        msgs = belief_propagation_batch(batch, psi, phi)
+        return self.log_score_batch(batch, self.pack_tags(batch, ms), psi, phi) - calculate_belief_sums(batch, msgs)
+
+    def dlog_prob_batch(self, trees, pos, ms, psi, phis=None):
+        """
+        Calculate the gradient of the log probability summed over many trees with respect to the psi parameters
+
+        :param trees: list of trees
+        :param pos: list of pos sequences
+        :param ms: list of tag sequences
+        :param psi: psi potentials
+        :param phis: list of phi potentials
+        :return: sum of dlog(p(m|T))/dpsi
+        """
+        if phis is None:
+            phis = self.create_phis(trees, pos, ms)
+        batch = pack_trees(trees, pos)
+        msgs = belief_propagation_batch(batch, psi, pack_phi(phis, batch))
+        dpsi_score = self.dlog_score_batch(batch, self.pack_tags(batch, ms), psi)
+        return dpsi_score - calculate_gradient_batch(msgs, batch, psi, True)
+
+    def best_sequence_batch(self, trees, pos, psi, phis, fix_tags=None):
+        """
+        Belief propagation (max-product) algorithm for calculating the best tag sequences for many trees at once
+
+        :param trees: list of trees
+        :param pos: list of pos sequences
+        :param psi: psi potentials
+        :param phis: list of phi potentials
+        :param fix_tags: list of lists of pairs of index of a word and the tag it should be fixed to for each tree
+        :return: list of tag sequences
+        """
+        batch = pack_trees(trees, pos)
+        phi = pack_phi(phis, batch)
+        if fix_tags:
+            size = batch.mask.shape[1]
+            for b in range(len(fix_tags)):
+                for idx, m in fix_tags[b]:
+                    phi[b * size + idx - 1, m] = 100
+        msgs, pointers = max_product_batch(batch, psi, phi)
+        best_tags = get_best_tags_batch(batch, msgs, pointers).tolist()
+        return [[self.get_tag(idx) for idx in best_tags[b][:len(trees[b])]] for b in range(len(trees))]
+
+    def best_sequences_batch(self, trees, pos, psi, phis, fix_tags):
+        """
+        Belief propagation (max-product) algorithm for calculating the best tag sequences of several combinations of
+        fixed tags for many trees at once. Every tree must have the same number of combinations, which are decoded in
+        a single pass with phi potentials of dimension [num_combinations, batch_size * size, num_tags]
+
+        :param trees: list of trees
+        :param pos: list of pos sequences
+        :param psi: psi potentials
+        :param phis: list of phi potentials
+        :param fix_tags: list with, for each tree, a list of combinations, which are lists of pairs of index of a word
+        and the tag it should be fixed to
+        :return: list with, for each tree, a list of tag sequences, one for each combination
+        """
+        batch = pack_trees(trees, pos)
+        size = batch.mask.shape[1]
+        num_combinations = len(fix_tags[0])
+        phi = pack_phi(phis, batch).repeat(num_combinations, 1, 1)
+        for b in range(len(fix_tags)):
+            if len(fix_tags[b]) != num_combinations:
+                raise ValueError("All trees must have the same number of combinations")
+            for c in range(num_combinations):
+                for idx, m in fix_tags[b][c]:
+                    phi[c, b * size + idx - 1, m] = 100
+        msgs, pointers = max_product_batch(batch, psi, phi)
+        best_tags = get_best_tags_batch(batch, msgs, pointers).tolist()
+        return [[[self.get_tag(idx) for idx in best_tags[c][b][:len(trees[b])]] for c in range(num_combinations)]
+                for b in range(len(trees))]
+
+    def best_sequences(self, T, pos, psi, phi, fix_tags):
+        """
+        Belief propagation (max-product) algorithm for calculating the best tag sequences of a tree for several
+        combinations of fixed tags in a single pass. Unlike best_sequence, phi is not modified
+
+        :param T: tree
+        :param pos: list of pos tags
+        :param psi: psi potentials
+        :param phi: phi potentials
+        :param fix_tags: list of combinations, which are lists of pairs of index of a word and the tag it should be
+        fixed to
+        :return: list of tag sequences, one for each combination
+        """
+        return self.best_sequences_batch([T], [pos], psi, [phi], [fix_tags])[0]
+
+    def best_sequences_incremental(self, T, pos, psi, phi, fix_tags):
+        """
+        Max-product algorithm for calculating the best tag sequences of a tree for several combinations of fixed tags.
+        The messages of the tree are computed once, and each combination only recomputes the messages on the paths
+        from its fixed words to the root. Unlike best_sequence, phi is not modified
+
+        :param T: tree
+        :param pos: list of pos tags
+        :param psi: psi potentials
+        :param phi: phi potentials
+        :param fix_tags: list of combinations, which are lists of pairs of index of a word and the tag it should be
+        fixed to
+        :return: list of tag sequences, one for each combination
+        """
+        decoder = IncrementalMaxProduct(T, pos, psi, phi)
+        sequences = []
+        for fixes in fix_tags:
+            updates = {}
+            for idx, m in fixes:
+                if idx not in updates:
+                    updates[idx] = phi[idx - 1].clone()
+                updates[idx][m] = 100
+            sequences.append([self.get_tag(idx) for idx in decoder.best_tags(updates)])
+        return sequences
+
     """
     Unit testing functions
     """
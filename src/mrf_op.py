@@ -1,79 +1,142 @@
 import torch
-from torch.autograd import Function
 import torch.nn as nn
 from model import Model
 
 
-class MRF(Function):
+class MRFLoss(nn.Module):
     """
-    Class to compute dpsi of a given sentence
+    Class to compute -log Pr(m|T) of a batch of sentences. Belief propagation only uses differentiable tensor
+    operations, so the gradient wrt psi is computed by autograd from the messages of the forward pass instead of a
+    second pass
     """
-    def __init__(self, model, sentence):
-        super(MRF, self).__init__()
-        self.sentence = sentence
+    def __init__(self, model, sentences, alpha=1):
+        super(MRFLoss, self).__init__()
+        self.sentences = sentences
         self.model = model
+        self.alpha = alpha
 
-    def forward(self, psi):
+    def forward(self, psi, phis=None):
         """
         :param psi: psi potentials to use in computing -log Pr(T|m)
-        :return: -log Pr(T|m)
+        :param phis: list of phi potentials of each sentence, None to create them from the tags of the sentences
+        :return: sum of -log Pr(T|m) over the sentences
         """
-        self.save_for_backward(psi)
-        val = -self.model.log_prob(self.sentence.T, self.sentence.pos, self.sentence.m, psi)
-        return torch.Tensor([val])
+        trees = [sentence.T for sentence in self.sentences]
+        pos = [sentence.pos for sentence in self.sentences]
+        ms = [sentence.m for sentence in self.sentences]
+        if phis is None:
+            phis = self.model.create_phis(trees, pos, ms, self.alpha)
+        return -self.model.log_prob_batch(trees, pos, ms, psi, phis).sum()
 
-    def backward(self, grad_output):
-        """
-        :param grad_output: N/A
-        :return: gradient of -log Pr(T|m) wrt psi
-        """
-        psi = self.saved_tensors[0]
-        dpsi = -self.model.dlog_prob(self.sentence.T, self.sentence.pos, self.sentence.m, psi)
-        del psi
-        return dpsi
+
+def get_neural_psi(pos, labs, W, psi_2):
+    """
+    :param pos: pos tags parameters
+    :param labs: dependency label parameters
+    :param W: weight matrix
+    :param psi_2: message parameters
+    :return: psi potentials of the neural parametrization
+    """
+    num_labels, num_pos, n = len(labs), len(pos), len(pos[0])
+    pos2 = pos.repeat((1, num_labels)).view(-1, n).repeat(num_pos, 1)
+    pos1 = pos.repeat((1, num_pos * num_labels)).view(-1, n)
+    labels = labs.repeat((num_pos * num_pos, 1))
+
+    psi_1 = torch.cat([pos1, pos2, labels], 1).reshape((num_pos, num_pos, num_labels, n * 3))
+    tanh = nn.Tanh()
+    psi = torch.tensordot(tanh(torch.tensordot(psi_1, W, 1)), psi_2, 1)
+    del pos2, pos1, labels, psi_1
+    return psi
 
 
 class MRF_NN(torch.nn.Module):
     """
     Class to initialize belief propagation model with neural parametrization of psi
     """
-    def __init__(self, tags, sentence=None):
+    def __init__(self, tags, alpha=1):
         super(MRF_NN, self).__init__()
         self.model = Model(tags)
-        self.sentence = sentence
-        
-    def forward(self, pos, labs, W, psi_2):
+        self.alpha = alpha
+
+    def forward(self, pos, labs, W, psi_2, sentences):
         """
         :param pos: pos tags parameters
         :param labs: dependency label parameters
         :param W: weight matrix
         :param psi_2: message parameters
-        :return: application of model to current sentence
+        :param sentences: batch of sentences
+        :return: application of model to the batch, psi is only computed once for the whole batch
         """
-        num_labels, num_pos, n = len(labs), len(pos), len(pos[0])
-        pos2 = pos.repeat((1, num_labels)).view(-1, n).repeat(num_pos, 1)
-        pos1 = pos.repeat((1, num_pos * num_labels)).view(-1, n)
-        labels = labs.repeat((num_pos * num_pos, 1))
-
-        psi_1 = torch.cat([pos1, pos2, labels], 1).reshape((num_pos, num_pos, num_labels, n * 3))
-        tanh = nn.Tanh()
-        psi = torch.tensordot(tanh(torch.tensordot(psi_1, W, 1)), psi_2, 1)
-        del pos2, pos1, labels, psi_1
-        return MRF(self.model, self.sentence)(psi)
+        psi = get_neural_psi(pos, labs, W, psi_2)
+        return MRFLoss(self.model, sentences, self.alpha)(psi)
 
 
 class MRF_Lin(torch.nn.Module):
     """
     Class to initialize belief propagation model with linear parametrization of psi
     """
-    def __init__(self, tags, sentence=None):
+    def __init__(self, tags, alpha=1):
         super(MRF_Lin, self).__init__()
         self.model = Model(tags)
-        self.sentence = sentence
+        self.alpha = alpha
 
-    def forward(self, psi):
+    def forward(self, psi, sentences):
         """
         :param psi: psi parameters
-        :return: application of model to current sentence
+        :param sentences: batch of sentences
+        :return: application of model to the batch
         """
-        return MRF(self.model, self.sentence)(psi)
+        return MRFLoss(self.model, sentences, self.alpha)(psi)
+
+
+"""
+Data-parallel training. Each worker process keeps the sentences and a shared-memory copy of psi, which the parent
+updates in place before every batch
+"""
+_shard_state = dict()
+
+
+def init_shard_worker(model, data, psi, alpha):
+    """
+    Initialize a worker process
+
+    :param model: Model
+    :param data: dictionary from split name to list of sentences
+    :param psi: shared-memory psi potentials
+    :param alpha: unary potential of the observed tags
+    """
+    torch.set_num_threads(1)
+    _shard_state.update(model=model, data=data, psi=psi, alpha=alpha)
+
+
+def shard_loss(task):
+    """
+    :param task: tuple of split name, start index, end index of the shard and True if the gradient should be computed
+    :return: sum of -log Pr(T|m) over the sentences of the shard and its gradient wrt psi (None if not computed)
+    """
+    split, start, end, with_grad = task
+    sentences = _shard_state['data'][split][start:end]
+    psi = _shard_state['psi'].clone().requires_grad_(with_grad)
+    with torch.set_grad_enabled(with_grad):
+        loss = MRFLoss(_shard_state['model'], sentences, _shard_state['alpha'])(psi)
+        if not with_grad:
+            return loss.item(), None
+        loss.backward()
+    return loss.item(), psi.grad
+
+
+def get_shards(start, end, num_shards):
+    """
+    :param start: index of the first sentence
+    :param end: index after the last sentence
+    :param num_shards: number of shards
+    :return: list of (start, end) pairs of contiguous non-empty shards
+    """
+    size, rest = divmod(end - start, num_shards)
+    shards = []
+    for k in range(num_shards):
+        shard_end = start + size + (1 if k < rest else 0)
+        if shard_end > start:
+            shards.append((start, shard_end))
+        start = shard_end
+    return shards
@@ -2,9 +2,11 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.autograd as autograd
-from mrf_op import MRF_NN, MRF_Lin
+import torch.multiprocessing as mp
+from mrf_op import MRF_NN, MRF_Lin, get_neural_psi, init_shard_worker, shard_loss, get_shards
 from Data import Data
 import os
+from math import ceil
 from tqdm import tqdm
 
 
@@ -12,7 +14,7 @@ from tqdm import tqdm
 class NeuralMRF(nn.Module):
     """ neural MRF """
 
-    def __init__(self, data, out_dir, linear, use_v1, hack_v2):
+    def __init__(self, data, out_dir, linear, use_v1, hack_v2, log_alpha=1):
         super(NeuralMRF, self).__init__()
 
         self.data = Data(data + "-train.conllu", data + "-dev.conllu", data + "-test.conllu", use_v1, hack_v2)
@@ -25,13 +27,13 @@ class NeuralMRF(nn.Module):
         self.linear = linear
 
         if self.linear:
-            self.mrf = MRF_Lin(self.data.tags)
+            self.mrf = MRF_Lin(self.data.tags, log_alpha)
             self.register_parameter('psi', None)
             self.psi = nn.Parameter(
                 torch.randn(self.num_pos, self.num_pos, self.num_labels, self.num_tags, self.num_tags,
                             dtype=torch.float64))
         else:
-            self.mrf = MRF_NN(self.data.tags)
+            self.mrf = MRF_NN(self.data.tags, log_alpha)
             self.n = 3
 
             self.register_parameter('pos', None)
@@ -47,59 +49,92 @@ class NeuralMRF(nn.Module):
             self.W = nn.Parameter(torch.randn(
                 (self.n * 3, self.n * 3), dtype=torch.float64))
 
-    def forward(self, sentence):
-        """ computation of the log-likelihood with pytorch """
-        self.mrf.sentence = sentence
+    def get_psi(self):
+        """ psi potentials of the current parameters """
         if self.linear:
-            return self.mrf(self.psi)
+            return self.psi
         else:
-            return self.mrf(self.pos, self.labels, self.W, self.psi_2)
+            return get_neural_psi(self.pos, self.labels, self.W, self.psi_2)
 
-    def fit(self, epochs=100, precision=1e-5):
-        self.optimizer = optim.Adam(self.parameters(), lr=0.001, weight_decay=0.001)
+    def forward(self, sentences):
+        """ computation of the negative log-likelihood of a batch of sentences with pytorch """
+        if self.linear:
+            return self.mrf(self.psi, sentences)
+        else:
+            return self.mrf(self.pos, self.labels, self.W, self.psi_2, sentences)
+
+    def parallel_loss(self, pool, workers, psi_shared, split, start, end, backward):
+        """ loss of a batch summed over shards computed by a pool of workers, gradients are propagated from psi """
+        psi = self.get_psi()
+        psi_shared.copy_(psi.detach())
+        tasks = [(split, shard_start, shard_end, backward)
+                 for shard_start, shard_end in get_shards(start, end, workers)]
+        results = pool.map(shard_loss, tasks)
+        # Reduce in shard order so results do not depend on which worker finishes first
+        loss = sum(res[0] for res in results)
+        if backward:
+            psi.backward(sum(res[1] for res in results))
+        return loss
+
+    def fit(self, epochs=100, lr=0.001, wd=0.001, batch_size=1, precision=1e-5, workers=1):
+        if workers > batch_size:
+            # A batch is split into at most batch_size shards, so the other workers would never get any work
+            raise ValueError("workers (" + str(workers) + ") cannot be larger than batch_size (" + str(batch_size) +
+                             ")")
+        self.optimizer = optim.Adam(self.parameters(), lr=lr, weight_decay=wd)
+        train, dev = self.data.train, self.data.dev
+        pool = None
+        if workers > 1:
+            psi_shared = self.get_psi().detach().clone().share_memory_()
+            pool = mp.Pool(workers, initializer=init_shard_worker,
+                           initargs=(self.mrf.model, {'train': train, 'dev': dev}, psi_shared, self.mrf.alpha))
+
+        def batch_loss(split, start, end, backward):
+            """ loss of a batch of sentences, computed in this process or by the pool of workers """
+            if pool is not None:
+                return self.parallel_loss(pool, workers, psi_shared, split, start, end, backward)
+            sentences = train if split == 'train' else dev
+            with torch.set_grad_enabled(backward):
+                loss = self.forward(sentences[start:end])
+                if backward:
+                    loss.backward()
+            return loss.item()
 
         def step():
             """ step in the optimization """
             train_loss = dev_loss = 0
             print("  Optimizing parameters on training data loss")
-            for sentence in tqdm(self.data, total=len(self.data.train)):
+            for start in tqdm(range(0, len(train), batch_size), total=ceil(len(train) / batch_size)):
                 self.optimizer.zero_grad()
-                loss = self.forward(sentence)
-                train_loss += loss
-                loss.backward()
+                train_loss += batch_loss('train', start, min(start + batch_size, len(train)), True)
                 self.optimizer.step()
-                del loss
             print("  Calculating dev loss")
-            for sentence in tqdm(self.data.dev, total=len(self.data.dev)):
-                dev_loss += self.forward(sentence)
-            return train_loss / len(self.data.train), dev_loss / len(self.data.dev)
-        for i in range(epochs):
-            print("Computing epoch", i + 1, "...")
-            # Do optimization step
-            train_loss, dev_loss = step()
-            # Save current parameters
-            file = os.path.join(self.out_dir, "psi_" +
-                                str(round(train_loss[0].item(), 6)) + "_" +
-                                str(round(dev_loss[0].item(), 6)) + "_epoch" + str(i + 1) + ".pt")
-            if self.linear:
-                torch.save(self.psi, file)
-            else:
-                pos2 = self.pos.repeat((1, self.num_labels)).view(-1, self.n).repeat(self.num_pos, 1)
-                pos1 = self.pos.repeat((1, self.num_pos * self.num_labels)).view(-1, self.n)
-                labels = self.labels.repeat((self.num_pos * self.num_pos, 1))
-                psi_1 = torch.cat([pos1, pos2, labels], 1).reshape((self.num_pos, self.num_pos, self.num_labels, self.n * 3))
-
-                tanh = nn.Tanh()
-                psi = torch.tensordot(tanh(torch.tensordot(psi_1, self.W, 1)), self.psi_2, 1)
-                torch.save(psi, file)
-                del pos2, pos1, labels, psi_1, psi
-
-            print("Completed epoch", i + 1)
-            print("    Training loss:", train_loss[0].item())
-            print("    Dev loss:     ", dev_loss[0].item())
-            if i > 0 and prev_loss - train_loss < precision:
-                break
-            prev_loss = train_loss
+            for start in tqdm(range(0, len(dev), batch_size), total=ceil(len(dev) / batch_size)):
+                dev_loss += batch_loss('dev', start, min(start + batch_size, len(dev)), False)
+            return train_loss / len(train), dev_loss / len(dev)
+        try:
+            for i in range(epochs):
+                print("Computing epoch", i + 1, "...")
+                # Do optimization step
+                train_loss, dev_loss = step()
+                # Save current parameters
+                file = os.path.join(self.out_dir, "psi_" +
+                                    str(round(train_loss, 6)) + "_" +
+                                    str(round(dev_loss, 6)) + "_epoch" + str(i + 1) + ".pt")
+                with torch.no_grad():
+                    torch.save(self.get_psi(), file)
+
+                print("Completed epoch", i + 1)
+                print("    Training loss:", train_loss)
+                print("    Dev loss:     ", dev_loss)
+                if i > 0 and prev_loss - train_loss < precision:
+                    break
+                prev_loss = train_loss
+        finally:
+            if pool is not None:
+                # Terminate rather than close, so that the workers also stop when training is interrupted
+                pool.terminate()
+                pool.join()
 
 
 if __name__ == "__main__":
@@ -111,8 +146,18 @@ if __name__ == "__main__":
     p.add_argument('--use_v1', default=False, action='store_true')
     p.add_argument('--hack_v2', default=False, action='store_true')
     p.add_argument('--linear', default=False, action='store_true')
+    p.add_argument('--epochs', default=100, type=int, help='maximum training epochs')
+    p.add_argument('--lr', default=0.001, type=float, help='learning rate')
+    p.add_argument('--wd', default=0.001, type=float, help='weight decay')
+    p.add_argument('--log_alpha', default=1, type=float, help='unary potential of the observed tags')
+    p.add_argument('--batch_size', default=1, type=int, help='number of sentences per optimization step')
+    p.add_argument('--workers', default=1, type=int, help='number of processes computing the gradients of a batch')
+    p.add_argument('--seed', default=0, type=int)
 
     args = p.parse_args()
+    if args.workers > args.batch_size:
+        p.error("--workers cannot be larger than --batch_size, a batch is split into at most --batch_size shards")
+    torch.manual_seed(args.seed)
 
-    nmrf = NeuralMRF(args.data, args.out_dir, args.linear, args.use_v1, args.hack_v2)
-    nmrf.fit()
+    nmrf = NeuralMRF(args.data, args.out_dir, args.linear, args.use_v1, args.hack_v2, args.log_alpha)
+    nmrf.fit(args.epochs, args.lr, args.wd, args.batch_size, workers=args.workers)
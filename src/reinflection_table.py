@@ -0,0 +1,48 @@
+import argparse
+import torch
+from utils.conll import load_partitions
+from utils.reinflection import get_gendered_words
+from sigmorphon_reinflection.cache import model_checksum
+from sigmorphon_reinflection.decode import decode_words, get_decoding_model
+from sigmorphon_reinflection.table import write_table
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--in_files', required=True, nargs='+', help='Input conllu files')
+    parser.add_argument('--out_file', required=True, help='Output reinflection table')
+    parser.add_argument('--reinflect', required=True, help='Path to reinflection model')
+    parser.add_argument('--batch_size', default=256, type=int, help='Number of words reinflected at once')
+    parser.add_argument('--quantize', default=False, action='store_true',
+                        help='Quantize the reinflection model to int8 and run it on CPU')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Program to reinflect every gendered word of a corpus to the other gender and store the forms in a table that
+    main.py and swap.py consult before the reinflection model
+    """
+    opt = get_args()
+    words = set()
+    for i in range(len(opt.in_files)):
+        print("Processing file " + str(i + 1) + " out of " + str(len(opt.in_files)) + " files")
+        with open(opt.in_files[i], "rb") as f:
+            for conll, _ in load_partitions(f, 10000):
+                words.update(get_gendered_words(conll))
+    print(len(words), "gendered words")
+
+    with torch.no_grad():
+        reinflection_model, device, decode_fn, decode_trg = get_decoding_model(opt.reinflect, quantize=opt.quantize)
+        words = sorted(words)
+        lemmas = [lemma for lemma, _ in words]
+        tags = [list(feats) for _, feats in words]
+        forms = decode_words(lemmas, tags, reinflection_model, device, decode_fn, decode_trg, opt.batch_size)
+
+    checksum = model_checksum(opt.reinflect) + ("-int8" if opt.quantize else "")
+    size = write_table(opt.out_file, checksum, zip(lemmas, tags, forms))
+    print("Wrote", size, "reinflections to", opt.out_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -54,6 +54,8 @@ def get_args():
     parser.add_argument('--model', required=True, help='dump model filename')
     parser.add_argument('--load', default='', help='load model and continue training; with `smart`, recover training automatically')
     parser.add_argument('--bs', default=20, type=int, help='training batch size')
+    parser.add_argument('--prefetch', default=False, action='store_true', help='assemble batches on a worker thread')
+    parser.add_argument('--cache_data', default=False, action='store_true', help='save the encoded data next to the data files and reuse it in later runs')
     parser.add_argument('--epochs', default=20, type=int, help='maximum training epochs')
     parser.add_argument('--optimizer', default='Adam', choices=['SGD', 'Adadelta', 'Adam'])
     parser.add_argument('--lr', default=1e-3, type=float, help='learning rate')
@@ -95,15 +97,15 @@ class Trainer(object):
         self.last_devloss = float('inf')
         self.models = list()
 
-    def load_data(self, dataset, train, dev, test=None):
+    def load_data(self, dataset, train, dev, test=None, prefetch=False, cache=False):
         assert self.data is None
         logger = self.logger
         # yapf: disable
         if dataset == Data.sigmorphon19task1:
-            self.data = dataloader.TagSIGMORPHON2019Task1(train, dev, test)
+            self.data = dataloader.TagSIGMORPHON2019Task1(train, dev, test, prefetch, cache)
         elif dataset == Data.sigmorphon19task2:
             assert isinstance(train, list) and len(train) == 1
-            self.data = dataloader.TagSIGMORPHON2019Task2(train, dev, test)
+            self.data = dataloader.TagSIGMORPHON2019Task2(train, dev, test, prefetch, cache)
         else:
             raise ValueError
         # yapf: enable
@@ -357,7 +359,7 @@ def main():
         torch.cuda.manual_seed_all(opt.seed)
 
     trainer = Trainer(logger)
-    trainer.load_data(opt.dataset, opt.train, opt.dev, test=opt.test)
+    trainer.load_data(opt.dataset, opt.train, opt.dev, test=opt.test, prefetch=opt.prefetch, cache=opt.cache_data)
     if opt.load and opt.load != '0':
         if os.path.isfile(opt.load):
             start_epoch = trainer.load_model(opt.load) + 1
@@ -0,0 +1,109 @@
+'''
+Memoization of reinflections
+'''
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+
+def model_checksum(model_file):
+    '''
+    sha1 checksum of a model file, reinflections are only reused for the same model
+    '''
+    sha1 = hashlib.sha1()
+    with open(model_file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ReinflectionCache(object):
+    '''
+    LRU cache of reinflected forms keyed by (lemma, tags), optionally backed by
+    a precomputed ReinflectionTable and a sqlite database so that later and
+    resumed runs can reuse reinflections
+    '''
+
+    def __init__(self, checksum, max_size=100000, db_file=None, table=None):
+        '''
+        checksum: checksum of the reinflection model
+        max_size: maximum number of forms kept in memory
+        db_file: sqlite database file, None to only cache in memory
+        table: ReinflectionTable built with the same model, consulted before
+        the database
+        '''
+        if table is not None and table.checksum != checksum:
+            raise ValueError('Reinflection table was built with another model')
+        self.checksum = checksum
+        self.max_size = max_size
+        self.forms = OrderedDict()
+        self.table = table
+        self.hits, self.table_hits, self.misses = 0, 0, 0
+        self.db = None
+        if db_file is not None:
+            self.db = sqlite3.connect(db_file)
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS reinflection (model TEXT, lemma TEXT, '
+                'tags TEXT, form TEXT, PRIMARY KEY (model, lemma, tags))')
+
+    @staticmethod
+    def key(lemma, tags):
+        return ''.join(lemma), ';'.join(tags)
+
+    def _remember(self, key, form):
+        self.forms[key] = form
+        self.forms.move_to_end(key)
+        if len(self.forms) > self.max_size:
+            self.forms.popitem(last=False)
+
+    def get(self, lemma, tags):
+        '''
+        cached form of lemma with tags, None if it has not been reinflected yet
+        '''
+        key = self.key(lemma, tags)
+        form = self.forms.get(key)
+        if form is None and self.table is not None:
+            form = self.table.get(lemma, tags)
+            if form is not None:
+                self.table_hits += 1
+        if form is None and self.db is not None:
+            row = self.db.execute(
+                'SELECT form FROM reinflection WHERE model = ? AND lemma = ? AND tags = ?',
+                (self.checksum, ) + key).fetchone()
+            form = row[0] if row is not None else None
+        if form is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, form)
+        return form
+
+    def put(self, lemma, tags, form):
+        key = self.key(lemma, tags)
+        self._remember(key, form)
+        if self.db is not None:
+            self.db.execute(
+                'INSERT OR REPLACE INTO reinflection VALUES (?, ?, ?, ?)',
+                (self.checksum, ) + key + (form, ))
+
+    def report(self):
+        '''
+        print and reset the hit/miss counters, and save new forms to disk
+        '''
+        if self.table is not None:
+            print("    Reinflection cache:", self.hits, "hits (" + str(self.table_hits), "from table),", self.misses,
+                  "misses")
+        else:
+            print("    Reinflection cache:", self.hits, "hits,", self.misses, "misses")
+        self.hits, self.table_hits, self.misses = 0, 0, 0
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
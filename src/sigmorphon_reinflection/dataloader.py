@@ -1,3 +1,12 @@
+import argparse
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
 import torch
 
 BOS = '<s>'
@@ -10,14 +19,150 @@ EOS_IDX = 2
 UNK_IDX = 3
 
 
+def prefetch(generator, size=1):
+    '''
+    run generator on a worker thread, keeping up to size items ready ahead of
+    the consumer
+    '''
+    items = queue.Queue(maxsize=size)
+    done = object()
+
+    def worker():
+        try:
+            for item in generator:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(done)
+
+    threading.Thread(target=worker, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class PackedSequences(object):
+    '''
+    sequences concatenated into a single flat tensor, so that any range of
+    them can be padded with a single gather
+    '''
+
+    def __init__(self, lengths, flat):
+        '''
+        lengths: length of each sequence
+        flat: concatenated sequences followed by one padding element, so that
+        padded positions can be gathered too
+        '''
+        self.lengths = lengths
+        self.flat = flat
+        self.offsets = torch.zeros_like(lengths)
+        if len(lengths) > 0:
+            self.offsets[1:] = lengths.cumsum(0)[:-1]
+
+    @classmethod
+    def from_lists(cls, seqs, device):
+        lengths = [len(seq) for seq in seqs]
+        flat = [x for seq in seqs for x in seq] + [PAD_IDX]
+        return cls(
+            torch.tensor(lengths, dtype=torch.long, device=device),
+            torch.tensor(flat, dtype=torch.long, device=device))
+
+    def pad(self, start, end):
+        '''
+        returns sequences start to end padded to [max_len x batch] and their
+        mask
+        '''
+        lengths = self.lengths[start:end]
+        steps = torch.arange(
+            int(lengths.max()), device=lengths.device).unsqueeze(1)
+        mask = steps < lengths.unsqueeze(0)
+        idx = torch.where(mask, self.offsets[start:end].unsqueeze(0) + steps,
+                          torch.full_like(mask, len(self.flat) - 1,
+                                          dtype=torch.long))
+        return self.flat[idx], mask.float()
+
+
+def save_packed(filename, nb_data, packed):
+    '''
+    save packed fields as a single int64 array: the number of fields and
+    instances, the size of each flat field, then the lengths and flat
+    sequences of each field
+    '''
+    header = [len(packed), nb_data] + [len(field.flat) for field in packed]
+    arrays = [np.array(header, dtype=np.int64)]
+    for field in packed:
+        arrays.append(field.lengths.cpu().numpy())
+        arrays.append(field.flat.cpu().numpy())
+    # write to a temporary file first so that an interrupted run leaves no
+    # broken cache behind
+    tmp_file = filename + '.tmp.npy'
+    np.save(tmp_file, np.concatenate(arrays))
+    os.replace(tmp_file, filename)
+
+
+def load_packed(filename, device):
+    '''
+    memory-map packed fields saved with save_packed
+    '''
+    # copy-on-write, so the fields can be used as tensors without a copy
+    array = np.load(filename, mmap_mode='c')
+    nb_fields, nb_data = int(array[0]), int(array[1])
+    pos = 2 + nb_fields
+    packed = []
+    for size in array[2:pos].tolist():
+        lengths = torch.from_numpy(array[pos:pos + nb_data]).to(device)
+        flat = torch.from_numpy(array[pos + nb_data:pos + nb_data + size])
+        packed.append(PackedSequences(lengths, flat.to(device)))
+        pos += nb_data + size
+    return nb_data, packed
+
+
+def file_checksum(filename):
+    '''
+    sha1 of the content of a file, saved next to it with its size and
+    modification time so that it is only computed again when they change
+    '''
+    stat = os.stat(filename)
+    key = [stat.st_size, stat.st_mtime_ns]
+    checksum_file = filename + '.sha1.json'
+    try:
+        with open(checksum_file, 'r', encoding='utf-8') as fp:
+            saved = json.load(fp)
+        if saved['stat'] == key:
+            return saved['sha1']
+    except (OSError, ValueError, KeyError):
+        pass
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha1.update(chunk)
+    checksum = sha1.hexdigest()
+    try:
+        with open(checksum_file + '.tmp', 'w', encoding='utf-8') as fp:
+            json.dump(dict(stat=key, sha1=checksum), fp)
+        os.replace(checksum_file + '.tmp', checksum_file)
+    except OSError as e:
+        print('Could not save', checksum_file + ':', e)
+    return checksum
+
+
 class Dataloader(object):
     def __init__(self):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 class Seq2SeqDataLoader(Dataloader):
-    def __init__(self, train_file, dev_file, test_file=None):
+    def __init__(self, train_file, dev_file, test_file=None, prefetch=False,
+                 cache=False):
         super().__init__()
+        # assemble the next batch on a worker thread while the current one is used
+        self.prefetch = prefetch
+        # save the vocabulary and the encoded files next to the data
+        self.cache = cache
         # assert os.path.isfile(train_file)
         # assert os.path.isfile(dev_file)
         # assert test_file is None or os.path.isfile(test_file)
@@ -27,7 +172,7 @@ class Seq2SeqDataLoader(Dataloader):
         self.batch_data = dict()
         self.nb_train, self.nb_dev, self.nb_test = 0, 0, 0
         self.nb_attr = 0
-        self.source, self.target = self.build_vocab()
+        self.source, self.target = self.load_vocab()
         self.source_vocab_size = len(self.source)
         self.target_vocab_size = len(self.target)
         if self.nb_attr > 0:
@@ -73,33 +218,95 @@ class Seq2SeqDataLoader(Dataloader):
         target = [PAD, BOS, EOS, UNK] + sorted(list(trg_set))
         return source, target
 
+    def load_vocab(self):
+        '''
+        build_vocab, the result is read from the cache if the data has not
+        changed since it was saved
+        '''
+        if not self.cache:
+            return self.build_vocab()
+        files = list(self.train_file) + [self.dev_file]
+        if self.test_file is not None:
+            files.append(self.test_file)
+        cache_file = self._cache_file(files, 'vocab', 'json')
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'r', encoding='utf-8') as fp:
+                vocab = json.load(fp)
+        else:
+            source, target = self.build_vocab()
+            vocab = dict(
+                source=source,
+                target=target,
+                nb_attr=self.nb_attr,
+                nb_train=self.nb_train,
+                nb_dev=self.nb_dev,
+                nb_test=self.nb_test)
+
+            def save_vocab(filename):
+                with open(filename + '.tmp', 'w', encoding='utf-8') as fp:
+                    json.dump(vocab, fp)
+                os.replace(filename + '.tmp', filename)
+
+            self._save_cache(cache_file, save_vocab)
+        self.nb_attr = vocab['nb_attr']
+        self.nb_train = vocab['nb_train']
+        self.nb_dev = vocab['nb_dev']
+        self.nb_test = vocab['nb_test']
+        return vocab['source'], vocab['target']
+
+    def _cache_file(self, files, kind, ext, *keys):
+        '''
+        cache file next to the first of files, named after the content of
+        files, the class encoding them and keys
+        '''
+        sha1 = hashlib.sha1(type(self).__name__.encode('utf-8'))
+        for file in files:
+            sha1.update(file_checksum(file).encode('utf-8'))
+        for key in keys:
+            sha1.update(json.dumps(key).encode('utf-8'))
+        return '{}.{}-{}.{}'.format(files[0], kind, sha1.hexdigest()[:16], ext)
+
+    def _save_cache(self, cache_file, save_fn):
+        try:
+            save_fn(cache_file)
+        except OSError as e:
+            print('Could not save', cache_file + ':', e)
+
     def read_file(self, file):
         raise NotImplementedError
 
-    def _batch_helper(self, lst):
-        bs = len(lst)
-        srcs, trgs = [], []
-        max_src_len, max_trg_len = 0, 0
-        for _, src, trg in lst:
-            max_src_len = max(len(src), max_src_len)
-            max_trg_len = max(len(trg), max_trg_len)
-            srcs.append(src)
-            trgs.append(trg)
-        batch_src = torch.zeros(
-            (max_src_len, bs), dtype=torch.long, device=self.device)
-        batch_src_mask = torch.zeros(
-            (max_src_len, bs), dtype=torch.float, device=self.device)
-        batch_trg = torch.zeros(
-            (max_trg_len, bs), dtype=torch.long, device=self.device)
-        batch_trg_mask = torch.zeros(
-            (max_trg_len, bs), dtype=torch.float, device=self.device)
-        for i in range(bs):
-            for j in range(len(srcs[i])):
-                batch_src[j, i] = srcs[i][j]
-                batch_src_mask[j, i] = 1
-            for j in range(len(trgs[i])):
-                batch_trg[j, i] = trgs[i][j]
-                batch_trg_mask[j, i] = 1
+    def _pack(self, lst):
+        '''
+        pack the fields of the encoded instances lst
+        '''
+        return [
+            PackedSequences.from_lists(field, self.device)
+            for field in zip(*lst)
+        ]
+
+    def _load_packed(self, file):
+        '''
+        encode the instances of file sorted by source length and pack them, the
+        packed instances are memory-mapped from the cache if it exists
+        '''
+        files = file if isinstance(file, list) else [file]
+        cache_file = None
+        if self.cache:
+            cache_file = self._cache_file(files, 'encoded', 'npy', self.source,
+                                          self.target)
+            if os.path.isfile(cache_file):
+                return load_packed(cache_file, self.device)
+        lst = sorted(self._iter_helper(file), key=lambda x: len(x[0]))
+        packed = self._pack(lst)
+        if cache_file is not None:
+            self._save_cache(
+                cache_file, lambda fn: save_packed(fn, len(lst), packed))
+        return len(lst), packed
+
+    def _batch_helper(self, packed, start, end):
+        src, trg = packed
+        batch_src, batch_src_mask = src.pad(start, end)
+        batch_trg, batch_trg_mask = trg.pad(start, end)
         return batch_src, batch_src_mask, batch_trg, batch_trg_mask
 
     def _batch_sample(self, batch_size, file):
@@ -108,14 +315,15 @@ class Seq2SeqDataLoader(Dataloader):
         else:
             key = file
         if key not in self.batch_data:
-            lst = list()
-            for src, trg in self._iter_helper(file):
-                lst.append((len(src), src, trg))
-            self.batch_data[key] = sorted(lst, key=lambda x: x[0])
+            self.batch_data[key] = self._load_packed(file)
 
-        lst = self.batch_data[key]
-        for start in range(0, len(lst), batch_size):
-            yield self._batch_helper(lst[start:start + batch_size])
+        nb_data, packed = self.batch_data[key]
+        batches = (self._batch_helper(packed, start,
+                                      min(start + batch_size, nb_data))
+                   for start in range(0, nb_data, batch_size))
+        if self.prefetch:
+            batches = prefetch(batches)
+        yield from batches
 
     def train_batch_sample(self, batch_size):
         yield from self._batch_sample(batch_size, self.train_file)
@@ -207,7 +415,7 @@ class SIGMORPHON2019Task1(Seq2SeqDataLoader):
 
     def read_file(self, file):
         with open(file, 'r', encoding='utf-8') as fp:
-            for line in fp.readlines():
+            for line in fp:
                 lemma, word, tags = line.strip().split('\t')
                 yield list(lemma), list(word), tags.split(';')
 
@@ -232,7 +440,7 @@ class SIGMORPHON2019Task1(Seq2SeqDataLoader):
 class SIGMORPHON2019Task2(SIGMORPHON2019Task1):
     def read_file(self, file):
         with open(file, 'r', encoding='utf-8') as fp:
-            for line in fp.readlines():
+            for line in fp:
                 toks = line.strip().split('\t')
                 if len(toks) < 2 or line[0] == '#':
                     continue
@@ -267,54 +475,14 @@ class TagSIGMORPHON2019Task1(SIGMORPHON2019Task1):
                         attr[attr_idx] = self.attr_c2i.get(tag, 0)
                 yield src, trg, attr
 
-    def _batch_helper(self, lst):
-        bs = len(lst)
-        srcs, trgs, attrs = [], [], []
-        max_src_len, max_trg_len, max_nb_attr = 0, 0, 0
-        for _, src, trg, attr in lst:
-            max_src_len = max(len(src), max_src_len)
-            max_trg_len = max(len(trg), max_trg_len)
-            max_nb_attr = max(len(attr), max_nb_attr)
-            srcs.append(src)
-            trgs.append(trg)
-            attrs.append(attr)
-        batch_attr = torch.zeros(
-            (bs, max_nb_attr), dtype=torch.long, device=self.device)
-        batch_src = torch.zeros(
-            (max_src_len, bs), dtype=torch.long, device=self.device)
-        batch_src_mask = torch.zeros(
-            (max_src_len, bs), dtype=torch.float, device=self.device)
-        batch_trg = torch.zeros(
-            (max_trg_len, bs), dtype=torch.long, device=self.device)
-        batch_trg_mask = torch.zeros(
-            (max_trg_len, bs), dtype=torch.float, device=self.device)
-        for i in range(bs):
-            for j in range(len(attrs[i])):
-                batch_attr[i, j] = attrs[i][j]
-            for j in range(len(srcs[i])):
-                batch_src[j, i] = srcs[i][j]
-                batch_src_mask[j, i] = 1
-            for j in range(len(trgs[i])):
-                batch_trg[j, i] = trgs[i][j]
-                batch_trg_mask[j, i] = 1
+    def _batch_helper(self, packed, start, end):
+        src, trg, attr = packed
+        batch_src, batch_src_mask = src.pad(start, end)
+        batch_trg, batch_trg_mask = trg.pad(start, end)
+        batch_attr = attr.pad(start, end)[0].t().contiguous()
         return ((batch_src, batch_attr), batch_src_mask, batch_trg,
                 batch_trg_mask)
 
-    def _batch_sample(self, batch_size, file):
-        if isinstance(file, list):
-            key = tuple(sorted(file))
-        else:
-            key = file
-        if key not in self.batch_data:
-            lst = list()
-            for src, trg, attr in self._iter_helper(file):
-                lst.append((len(src), src, trg, attr))
-            self.batch_data[key] = sorted(lst, key=lambda x: x[0])
-
-        lst = self.batch_data[key]
-        for start in range(0, len(lst), batch_size):
-            yield self._batch_helper(lst[start:start + batch_size])
-
     def train_sample(self):
         for src, trg, tags in self._iter_helper(self.train_file):
             yield ((torch.tensor(src, device=self.device).view(len(src), 1),
@@ -336,3 +504,37 @@ class TagSIGMORPHON2019Task1(SIGMORPHON2019Task1):
 
 class TagSIGMORPHON2019Task2(TagSIGMORPHON2019Task1, SIGMORPHON2019Task2):
     pass
+
+
+def main():
+    '''
+    measure how many training batches per second a dataloader assembles
+    '''
+    # yapf: disable
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train', required=True, nargs='+')
+    parser.add_argument('--dev', required=True)
+    parser.add_argument('--bs', default=20, type=int, help='batch size')
+    parser.add_argument('--epochs', default=5, type=int)
+    parser.add_argument('--prefetch', default=False, action='store_true')
+    parser.add_argument('--cache', default=False, action='store_true')
+    opt = parser.parse_args()
+    # yapf: enable
+    start = time.time()
+    data = TagSIGMORPHON2019Task1(opt.train, opt.dev, prefetch=opt.prefetch,
+                                  cache=opt.cache)
+    print('vocabulary: {:.3f}s'.format(time.time() - start))
+    start = time.time()
+    # the first epoch includes encoding the training data
+    nb_batch = sum(1 for _ in data.train_batch_sample(opt.bs))
+    print('encoding and first epoch: {:.3f}s'.format(time.time() - start))
+    start = time.time()
+    for _ in range(opt.epochs):
+        for _ in data.train_batch_sample(opt.bs):
+            pass
+    print('{:.1f} batches/s'.format(
+        nb_batch * opt.epochs / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,19 @@
 Decode model
 '''
 import argparse
+import os
+from collections import OrderedDict
 from functools import partial
 
 import torch
 
-from sigmorphon_reinflection.dataloader import BOS, EOS, UNK_IDX
-from sigmorphon_reinflection.reinflection_model import decode_beam_search, decode_greedy
+from sigmorphon_reinflection.dataloader import BOS, EOS, PAD_IDX, UNK_IDX
+from sigmorphon_reinflection.cache import model_checksum
+from sigmorphon_reinflection.export import CHECKSUM_FILE, SCRIPTED_SUFFIX, decode_greedy_scripted, \
+    decode_greedy_scripted_batch
+from sigmorphon_reinflection.quantize import is_quantized, quantize_model
+from sigmorphon_reinflection.reinflection_model import decode_beam_search, decode_beam_search_batch, decode_greedy, \
+    decode_greedy_batch
 from sigmorphon_reinflection.util import maybe_mkdir
 import sigmorphon_reinflection.reinflection_model as reinflection_model
 
@@ -22,6 +29,7 @@ def get_args():
     parser.add_argument('--decode', default='greedy', choices=['greedy', 'beam'])
     parser.add_argument('--beam_size', default=5, type=int)
     parser.add_argument('--nonorm', default=False, action='store_true')
+    parser.add_argument('--batch_size', default=256, type=int)
     return parser.parse_args()
     # yapf: enable
 
@@ -58,7 +66,12 @@ def read_file(filename):
             yield list(lemma), tags.split(';')
 
 
-def encode(model, lemma, tags, device):
+# Batched counterparts of the single word decoding functions
+_BATCH_DECODERS = {decode_greedy: decode_greedy_batch, decode_beam_search: decode_beam_search_batch,
+                   decode_greedy_scripted: decode_greedy_scripted_batch}
+
+
+def _encode_lists(model, lemma, tags):
     tag_shift = model.src_vocab_size - len(model.attr_c2i)
 
     src = []
@@ -75,17 +88,60 @@ def encode(model, lemma, tags, device):
             attr_idx = -1
         if attr[attr_idx] == 0:
             attr[attr_idx] = model.attr_c2i.get(tag, 0)
+    return src, attr
 
+
+def encode(model, lemma, tags, device):
+    src, attr = _encode_lists(model, lemma, tags)
     return (torch.tensor(src, device=device).view(len(src), 1),
             torch.tensor(attr, device=device).view(1, len(attr)))
 
 
-def get_decoding_model(model_file, use_greedy=True, max_len=100, beam_size=5, nonorm=False):
+def encode_batch(model, lemmas, tag_lists, device):
+    '''
+    returns padded sources [seq_len x batch], attributes [batch x nb_attr] and source mask [seq_len x batch]
+    '''
+    srcs, attrs = zip(*[_encode_lists(model, lemma, tags) for lemma, tags in zip(lemmas, tag_lists)])
+    max_len = max(len(src) for src in srcs)
+    src = torch.tensor([src + [PAD_IDX] * (max_len - len(src)) for src in srcs], device=device).t()
+    src_mask = (src != PAD_IDX).float()
+    return (src, torch.tensor(attrs, device=device)), src_mask
+
+
+def load_scripted(scripted_file, model_file, device):
+    '''
+    load a scripted model, None if it was not exported from model_file, e.g.
+    because model_file was retrained after the export
+    '''
+    extra_files = {CHECKSUM_FILE: ''}
+    model = torch.jit.load(scripted_file, map_location=device, _extra_files=extra_files)
+    if scripted_file != model_file and extra_files[CHECKSUM_FILE].decode() != model_checksum(model_file):
+        print('Ignoring', scripted_file, 'as it was not exported from the current', model_file)
+        return None
+    return model
+
+
+def get_decoding_model(model_file, use_greedy=True, max_len=100, beam_size=5, nonorm=False, prefer_scripted=True,
+                       quantize=False):
+    '''
+    load a reinflection model, for greedy decoding the scripted model exported next to model_file (or model_file
+    itself if it is scripted) is used if prefer_scripted is True and it was exported from model_file. If quantize is
+    True, the LSTM and linear layers of the model are quantized to int8 and the model runs on CPU.
+    '''
     with torch.no_grad():
         decode_fn = setup_inference_explicit(use_greedy, max_len, beam_size, nonorm)
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model = torch.load(open(model_file, mode='rb'), map_location=device)
+        device = torch.device("cuda" if torch.cuda.is_available() and not quantize else "cpu")
+        scripted_file = model_file if model_file.endswith(SCRIPTED_SUFFIX) else model_file + SCRIPTED_SUFFIX
+        model = None
+        if use_greedy and prefer_scripted and not quantize and os.path.isfile(scripted_file):
+            model = load_scripted(scripted_file, model_file, device)
+        if model is not None:
+            decode_fn = partial(decode_greedy_scripted, max_len=max_len)
+        else:
+            model = torch.load(open(model_file, mode='rb'), map_location=device)
+        if quantize:
+            model = quantize_model(model)
         model = model.to(device)
 
         trg_i2c = {i: c for c, i in model.trg_c2i.items()}
@@ -94,10 +150,54 @@ def get_decoding_model(model_file, use_greedy=True, max_len=100, beam_size=5, no
         return model, device, decode_fn, decode_trg
 
 
-def decode_word(lemma, tags, model, device, decode_fn, decode_trg):
+def decode_word(lemma, tags, model, device, decode_fn, decode_trg, cache=None):
+    if cache is not None:
+        form = cache.get(lemma, tags)
+        if form is not None:
+            return form
     src = encode(model, lemma, tags, device)
     pred, _ = decode_fn(model, src)
-    return ''.join(decode_trg(pred))
+    form = ''.join(decode_trg(pred))
+    if cache is not None:
+        cache.put(lemma, tags, form)
+    return form
+
+
+def _decode_batches(lemmas, tags, model, device, decode_fn, decode_trg, batch_size):
+    batch_fn = _BATCH_DECODERS.get(getattr(decode_fn, 'func', decode_fn))
+    # the activations of quantized models are scaled per batch, so their words are decoded alone to get the same form
+    # whatever the other words of the batch are
+    if batch_fn is None or is_quantized(model):
+        return [decode_word(lemma, tag, model, device, decode_fn, decode_trg) for lemma, tag in zip(lemmas, tags)]
+    keywords = getattr(decode_fn, 'keywords', {})
+    forms = []
+    for start in range(0, len(lemmas), batch_size):
+        src, src_mask = encode_batch(model, lemmas[start:start + batch_size], tags[start:start + batch_size], device)
+        preds = batch_fn(model, src, src_mask, **keywords)
+        forms.extend(''.join(decode_trg(pred)) for pred in preds)
+    return forms
+
+
+def decode_words(lemmas, tags, model, device, decode_fn, decode_trg, batch_size=256, cache=None):
+    '''
+    decode many words at once, every distinct word is decoded only once and falls back to decoding word by word if
+    decode_fn has no batched version or the model is quantized
+    '''
+    forms = OrderedDict()
+    for lemma, tag in zip(lemmas, tags):
+        forms.setdefault((tuple(lemma), tuple(tag)), None)
+    if cache is not None:
+        for lemma, tag in forms:
+            forms[lemma, tag] = cache.get(lemma, tag)
+    missing = [word for word, form in forms.items() if form is None]
+    if missing:
+        new_lemmas, new_tags = zip(*missing)
+        new_forms = _decode_batches(new_lemmas, new_tags, model, device, decode_fn, decode_trg, batch_size)
+        for (lemma, tag), form in zip(missing, new_forms):
+            forms[lemma, tag] = form
+            if cache is not None:
+                cache.put(lemma, tag, form)
+    return [forms[tuple(lemma), tuple(tag)] for lemma, tag in zip(lemmas, tags)]
 
 
 def main():
@@ -113,12 +213,11 @@ def main():
     decode_trg = lambda seq: [trg_i2c[i] for i in seq]
 
     maybe_mkdir(opt.out_file)
+    lemmas, tags = zip(*read_file(opt.in_file))
+    preds = decode_words(lemmas, tags, model, device, decode_fn, decode_trg, opt.batch_size)
     with open(opt.out_file, 'w', encoding='utf-8') as fp:
-        for lemma, tags in read_file(opt.in_file):
-            src = encode(model, lemma, tags, device)
-            pred, _ = decode_fn(model, src)
-            pred_out = ''.join(decode_trg(pred))
-            fp.write("".join(lemma) + '\t' + pred_out + '\t' + ";".join(tags[1:]) + '\n')
+        for lemma, tag, pred_out in zip(lemmas, tags, preds):
+            fp.write("".join(lemma) + '\t' + pred_out + '\t' + ";".join(tag[1:]) + '\n')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+'''
+Export a reinflection model to TorchScript
+'''
+import argparse
+import time
+from typing import List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from sigmorphon_reinflection.cache import model_checksum
+from sigmorphon_reinflection.dataloader import BOS_IDX, EOS_IDX
+from sigmorphon_reinflection.reinflection_model import EPSILON, HardAttnTransducer, HMMTransducer, TagTransducer
+
+SCRIPTED_SUFFIX = '.scripted'
+# Extra file of a scripted model holding the checksum of the model it was exported from
+CHECKSUM_FILE = 'source_checksum'
+
+
+def get_args():
+    # yapf: disable
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, help='Path to model')
+    parser.add_argument('--out_file', default=None, help='Output file, defaults to the model path + ' + SCRIPTED_SUFFIX)
+    parser.add_argument('--check', default=None, help='Reinflection file to compare the scripted and eager model on')
+    parser.add_argument('--max_len', default=100, type=int)
+    return parser.parse_args()
+    # yapf: enable
+
+
+class ScriptedGreedyDecoder(nn.Module):
+    '''
+    encoder and greedy decoding loop of a soft or hard attention tag transducer
+    in a single scriptable module
+    '''
+
+    def __init__(self, model):
+        super().__init__()
+        if not isinstance(model, TagTransducer) or isinstance(
+                model, HMMTransducer) or model.nb_attr == 0:
+            raise ValueError('Only soft and hard attention tag transducers '
+                             'can be exported, got ' + type(model).__name__)
+        self.src_c2i = model.src_c2i
+        self.trg_c2i = model.trg_c2i
+        self.attr_c2i = model.attr_c2i
+        self.src_vocab_size = model.src_vocab_size
+        self.nb_attr = model.nb_attr
+        self.hard_attn = isinstance(model, HardAttnTransducer)
+        self.epsilon = EPSILON
+        self.src_embed = model.src_embed
+        self.attr_embed = model.attr_embed
+        self.merge_attr = model.merge_attr
+        self.enc_rnn = model.enc_rnn
+        self.scale_enc_hs = model.scale_enc_hs
+        self.trg_embed = model.trg_embed
+        self.dec_layers = model.dec_rnn.layers
+        self.trg_hid_size = model.trg_hid_size
+        self.linear_out = model.linear_out
+        self.final_out = model.final_out
+
+    def forward(self, src: Tensor, src_mask: Tensor, attr: Tensor,
+                max_len: int, trg_bos: int, trg_eos: int) -> Tensor:
+        '''
+        src: seq_len x batch, padded source words
+        src_mask: seq_len x batch
+        attr: batch x nb_attr
+        returns the decoded words: nb_steps x batch, every row is decoded
+        until all rows have produced trg_eos
+        '''
+        bat_siz = src.size(1)
+        new_idx = torch.arange(
+            1, self.nb_attr + 1, device=attr.device).expand(bat_siz, -1)
+        attr = ((attr > 1).float() * new_idx.float()).long()
+        enc_attr = F.relu(
+            self.merge_attr(self.attr_embed(attr).view(bat_siz, -1)))
+        packed = pack_padded_sequence(
+            self.src_embed(src), src_mask.sum(0).long().cpu(),
+            enforce_sorted=False)
+        enc_hs = pad_packed_sequence(
+            self.enc_rnn(packed)[0], total_length=src.size(0))[0]
+        # batch x seq_len x hid_dim
+        scale_enc_hs = self.scale_enc_hs(enc_hs).transpose(0, 1)
+        enc_hs = enc_hs.transpose(0, 1)
+        mask = src_mask.transpose(0, 1)
+
+        h: List[Tensor] = []
+        c: List[Tensor] = []
+        for init_layer in self.dec_layers:
+            h.append(torch.zeros((bat_siz, self.trg_hid_size), device=src.device))
+            c.append(torch.zeros((bat_siz, self.trg_hid_size), device=src.device))
+        input_ = self.trg_embed(
+            torch.full((bat_siz, ), trg_bos, dtype=torch.long,
+                       device=src.device))
+        finished = torch.zeros(bat_siz, dtype=torch.bool, device=src.device)
+        output: List[Tensor] = []
+        for step in range(max_len):
+            h_t = torch.cat((input_, enc_attr), dim=1)
+            new_h: List[Tensor] = []
+            new_c: List[Tensor] = []
+            i = 0
+            for layer in self.dec_layers:
+                h_t, c_t = layer(h_t, (h[i], c[i]))
+                new_h.append(h_t)
+                new_c.append(c_t)
+                i += 1
+            h, c = new_h, new_c
+
+            score = torch.bmm(scale_enc_hs, h_t.unsqueeze(2)).squeeze(2)
+            attn = F.softmax(score, dim=-1) * mask + self.epsilon
+            attn = (attn / attn.sum(-1, keepdim=True)).unsqueeze(1)
+            if self.hard_attn:
+                ctx = torch.cat((h_t.unsqueeze(1).expand(
+                    -1, enc_hs.size(1), -1), enc_hs), dim=2)
+                ctx = torch.tanh(self.linear_out(ctx))
+                word_prob = F.softmax(self.final_out(ctx), dim=-1)
+                word_logprob = torch.log(torch.bmm(attn, word_prob).squeeze(1))
+            else:
+                ctx = torch.cat((torch.bmm(attn, enc_hs).squeeze(1), h_t), dim=1)
+                ctx = torch.tanh(self.linear_out(ctx))
+                word_logprob = F.log_softmax(self.final_out(ctx), dim=-1)
+            word = torch.max(word_logprob, dim=1)[1]
+            finished = finished | (word == trg_eos)
+            output.append(word)
+            if bool(finished.all()):
+                break
+            input_ = self.trg_embed(word)
+        return torch.stack(output)
+
+
+def export_model(model, out_file, checksum=''):
+    '''
+    script the greedy decoder of a model and save it to out_file, together with
+    the checksum of the model file so that a stale export can be detected
+    '''
+    model.eval()
+    scripted = torch.jit.script(ScriptedGreedyDecoder(model).cpu())
+    scripted.save(out_file, _extra_files={CHECKSUM_FILE: checksum})
+    return scripted
+
+
+def decode_greedy_scripted(model, src_sentence, max_len=100, trg_bos=BOS_IDX,
+                           trg_eos=EOS_IDX):
+    '''
+    src_sentence: tuple of source [seq_len x 1] and attributes [1 x nb_attr]
+    '''
+    src, attr = src_sentence
+    return decode_greedy_scripted_batch(
+        model, (src, attr), torch.ones_like(src, dtype=torch.float), max_len,
+        trg_bos, trg_eos)[0], []
+
+
+def decode_greedy_scripted_batch(model, src_batch, src_mask, max_len=100,
+                                 trg_bos=BOS_IDX, trg_eos=EOS_IDX):
+    '''
+    src_batch: tuple of padded sources [seq_len x batch] and attributes
+    [batch x nb_attr]
+    src_mask: [seq_len x batch]
+    returns the output of each source word
+    '''
+    src, attr = src_batch
+    words = model(src, src_mask, attr, max_len, trg_bos, trg_eos)
+    rows = words.t().tolist()
+    for i, row in enumerate(rows):
+        if trg_eos in row:
+            rows[i] = row[:row.index(trg_eos)]
+    return rows
+
+
+def main():
+    '''
+    export a model and optionally compare it with the eager model
+    '''
+    from sigmorphon_reinflection.decode import decode_word, get_decoding_model, read_file
+
+    opt = get_args()
+    out_file = opt.out_file or opt.model + SCRIPTED_SUFFIX
+    model = torch.load(open(opt.model, mode='rb'), map_location='cpu')
+    export_model(model, out_file, model_checksum(opt.model))
+    print('Saved scripted model to', out_file)
+    if opt.check is None:
+        return
+    data = list(read_file(opt.check))
+    eager = get_decoding_model(opt.model, max_len=opt.max_len, prefer_scripted=False)
+    scripted = get_decoding_model(out_file, max_len=opt.max_len)
+    forms = []
+    for name, (model, device, decode_fn, decode_trg) in [('eager', eager), ('scripted', scripted)]:
+        start = time.time()
+        forms.append([decode_word(lemma, tags, model, device, decode_fn, decode_trg) for lemma, tags in data])
+        latency = (time.time() - start) / len(data) * 1000
+        print('{}: {:.3f} ms per word'.format(name, latency))
+    nb_diff = sum(eager_form != scripted_form for eager_form, scripted_form in zip(*forms))
+    print('Outputs identical' if nb_diff == 0 else '{} of {} outputs differ'.format(nb_diff, len(data)))
+
+
+if __name__ == '__main__':
+    with torch.no_grad():
+        main()
@@ -0,0 +1,113 @@
+'''
+Dynamic int8 quantization of reinflection models
+
+Dynamic quantization picks the scale of the activations from each batch, so
+the form of a word would depend on the other words of its batch. Quantized
+models are therefore decoded one word at a time by decode_words.
+'''
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+import torch.ao.nn.quantized.dynamic as nnqd
+
+from sigmorphon_reinflection.util import BasicEvaluator, Eval
+
+QUANTIZED_MODULES = (nnqd.LSTM, nnqd.LSTMCell, nnqd.Linear)
+
+
+def get_args():
+    # yapf: disable
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, help='Path to model')
+    parser.add_argument('--in_file', required=True, help='Held-out reinflection file (lemma, form and tags)')
+    parser.add_argument('--max_len', default=100, type=int)
+    parser.add_argument('--decode', default='greedy', choices=['greedy', 'beam'])
+    parser.add_argument('--beam_size', default=5, type=int)
+    parser.add_argument('--batch_size', default=256, type=int)
+    return parser.parse_args()
+    # yapf: enable
+
+
+def quantize_model(model):
+    '''
+    quantize the weights of the LSTM and linear layers of a model to int8,
+    activations are quantized on the fly. The quantized model only runs on
+    CPU.
+    '''
+    model = model.cpu().eval()
+    return torch.quantization.quantize_dynamic(
+        model, {nn.LSTM, nn.LSTMCell, nn.Linear}, dtype=torch.qint8)
+
+
+def is_quantized(model):
+    '''
+    whether some layers of model are dynamically quantized
+    '''
+    return any(isinstance(module, QUANTIZED_MODULES) for module in model.modules())
+
+
+def read_samples(filename):
+    with open(filename, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            lemma, form, tags = line.strip().split('\t')
+            yield list(lemma), list(form), tags.split(';')
+
+
+def evaluate_model(model, device, decode_fn, decode_trg, samples,
+                   batch_size=256):
+    '''
+    accuracy and average edit distance of a decoding model on samples, and its
+    average latency in ms per word. Words are decoded with decode_words like in
+    main.py, so the report measures what is used for conversion.
+    '''
+    from sigmorphon_reinflection.decode import decode_words
+
+    lemmas = [lemma for lemma, _, _ in samples]
+    tags = [tags for _, _, tags in samples]
+    start = time.time()
+    preds = decode_words(lemmas, tags, model, device, decode_fn, decode_trg,
+                         batch_size)
+    latency = (time.time() - start) / len(samples) * 1000
+
+    evaluator = BasicEvaluator()
+    correct, distance = 0, 0
+    for pred, (_, form, _) in zip(preds, samples):
+        corr, dist = evaluator.evaluate(list(pred), form)
+        correct += corr
+        distance += dist
+    results = [
+        Eval('acc', 'accuracy', round(correct / len(samples) * 100, 4)),
+        Eval('dist', 'average edit distance',
+             round(distance / len(samples), 4))
+    ]
+    return results, latency
+
+
+def main():
+    '''
+    compare the accuracy and latency of the float and quantized model
+    '''
+    from sigmorphon_reinflection.decode import get_decoding_model
+
+    opt = get_args()
+    samples = list(read_samples(opt.in_file))
+    for name, quantize in [('float', False), ('int8', True)]:
+        model, device, decode_fn, decode_trg = get_decoding_model(
+            opt.model, opt.decode == 'greedy', opt.max_len, opt.beam_size,
+            prefer_scripted=False, quantize=quantize)
+        results, latency = evaluate_model(model, device, decode_fn,
+                                          decode_trg, samples, opt.batch_size)
+        print('{}: {} {:.3f} ms per word'.format(
+            name,
+            ' '.join('{} {}'.format(res.long_desc, res.res) for res in results),
+            latency))
+
+
+if __name__ == '__main__':
+    with torch.no_grad():
+        main()
@@ -7,6 +7,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from sigmorphon_reinflection.dataloader import BOS_IDX, EOS_IDX, PAD_IDX
 
@@ -33,14 +34,14 @@ class StackedLSTM(nn.Module):
             self.layers.append(nn.LSTMCell(input_siz, rnn_siz))
             input_siz = rnn_siz
 
-    def get_init_hx(self, batch_size):
+    def get_init_hx(self, batch_size, device=DEVICE):
         '''
         initial h0
         '''
         h_0_s, c_0_s = [], []
         for _ in range(self.nb_layers):
-            h_0 = torch.zeros((batch_size, self.rnn_siz), device=DEVICE)
-            c_0 = torch.zeros((batch_size, self.rnn_siz), device=DEVICE)
+            h_0 = torch.zeros((batch_size, self.rnn_siz), device=device)
+            c_0 = torch.zeros((batch_size, self.rnn_siz), device=device)
             h_0_s.append(h_0)
             c_0_s.append(c_0)
         return (h_0_s, c_0_s)
@@ -142,11 +143,18 @@ class Transducer(nn.Module):
         self.final_out = nn.Linear(self.out_dim, trg_vocab_size)
         self.dropout = nn.Dropout(dropout_p)
 
-    def encode(self, src_batch):
+    def encode(self, src_batch, src_lens=None):
         '''
-        encoder
+        encoder, padding is skipped by the rnn if src_lens is given
         '''
-        enc_hs, _ = self.enc_rnn(self.dropout(self.src_embed(src_batch)))
+        src_embed = self.dropout(self.src_embed(src_batch))
+        if src_lens is None:
+            enc_hs, _ = self.enc_rnn(src_embed)
+        else:
+            packed = pack_padded_sequence(
+                src_embed, src_lens.cpu(), enforce_sorted=False)
+            enc_hs, _ = pad_packed_sequence(
+                self.enc_rnn(packed)[0], total_length=src_embed.size(0))
         scale_enc_hs = self.scale_enc_hs(enc_hs)
         return enc_hs, scale_enc_hs
 
@@ -235,24 +243,35 @@ class HMM(object):
             mask = (idx != ignore_index).float()
             return emiss * mask
 
-    def p_x(self, seq, ignore_index=None):
+    def p_x(self, seq, ignore_index=None, lengths=None):
+        '''
+        seq: T x batch, padded target sequences
+        lengths: length of each target sequence, None if all have length T
+        returns the forward log probabilities after the last token of each
+        sequence: batch x 1 x nb_states
+        '''
         T, bs = seq.shape
         assert self.initial.shape == (bs, 1, self.ns)
         assert self.transition.shape == (T - 1, bs, self.ns, self.ns)
         assert self.emission.shape == (T, bs, self.ns, self.V)
+        # emissions of all tokens at once: T x batch x 1 x nb_states
+        idx = seq.view(T, bs, 1, 1).expand(T, bs, self.ns, 1)
+        emiss = torch.gather(self.emission, -1, idx).view(T, bs, 1, self.ns)
+        if ignore_index is not None:
+            emiss = emiss * (seq != ignore_index).float().view(T, bs, 1, 1)
         # fwd = pi * b[:, O[0]]
-        # fwd = self.initial * self.emiss(0, seq[0])
-        fwd = self.initial + self.emiss(0, seq[0], ignore_index=ignore_index)
+        fwd = self.initial + emiss[0]
+        final = fwd
         #induction:
         for t in range(T - 1):
             # fwd[t + 1] = np.dot(fwd[t], a) * b[:, O[t + 1]]
-            # fwd = torch.bmm(fwd, self.transition[t]) * self.emiss(
-            #     t + 1, seq[t + 1])
             fwd = fwd + self.transition[t].transpose(1, 2)
             fwd = fwd.logsumexp(dim=-1, keepdim=True).transpose(1, 2)
-            fwd = fwd + self.emiss(
-                t + 1, seq[t + 1], ignore_index=ignore_index)
-        return fwd
+            fwd = fwd + emiss[t + 1]
+            if lengths is not None:
+                final = torch.where((lengths == t + 2).view(bs, 1, 1), fwd,
+                                    final)
+        return fwd if lengths is None else final
 
 
 class HMMTransducer(Transducer):
@@ -265,7 +284,10 @@ class HMMTransducer(Transducer):
         seq_len = target.shape[0]
         hmm = HMM(predict.init.shape[-1], self.trg_vocab_size, predict.init,
                   predict.trans, predict.emiss)
-        loss = hmm.p_x(target, ignore_index=PAD_IDX)
+        # the forward probabilities of each target end at its last token, not at
+        # the end of the padding
+        lengths = (target != PAD_IDX).sum(0)
+        loss = hmm.p_x(target, ignore_index=PAD_IDX, lengths=lengths)
         return -torch.logsumexp(loss, dim=-1).mean() / seq_len
 
     def decode(self, enc_hs, enc_mask, trg_batch):
@@ -419,7 +441,7 @@ class TagTransducer(Transducer):
             self.dec_rnn = StackedLSTM(self.embed_dim, self.trg_hid_size,
                                        self.trg_nb_layers, self.dropout_p)
 
-    def encode(self, src_batch):
+    def encode(self, src_batch, src_lens=None):
         '''
         encoder
         '''
@@ -435,7 +457,7 @@ class TagTransducer(Transducer):
         else:
             src = src_batch
             enc_attr = None
-        enc_hs = super().encode(src)
+        enc_hs = super().encode(src, src_lens)
         return enc_hs, enc_attr
 
     def decode_step(self, enc_hs, enc_mask, input_, hidden):
@@ -469,6 +491,16 @@ class TagHardAttnTransducer(TagTransducer, HardAttnTransducer):
     pass
 
 
+def source_device(seq):
+    '''
+    device of a source sequence, decoding runs there instead of on DEVICE
+    because a model can be moved to CPU, e.g. when it is quantized
+    '''
+    if isinstance(seq, tuple):
+        seq = seq[0]
+    return seq.device
+
+
 def dummy_mask(seq):
     '''
     create dummy mask (all 1)
@@ -495,12 +527,13 @@ def decode_greedy(transducer,
             trg_bos=BOS_IDX,
             trg_eos=EOS_IDX)
     transducer.eval()
+    device = source_device(src_sentence)
     src_mask = dummy_mask(src_sentence)
     enc_hs = transducer.encode(src_sentence)
 
     output, attns = [], []
-    hidden = transducer.dec_rnn.get_init_hx(1)
-    input_ = torch.tensor([trg_bos], device=DEVICE)
+    hidden = transducer.dec_rnn.get_init_hx(1, device)
+    input_ = torch.tensor([trg_bos], device=device)
     input_ = transducer.dropout(transducer.trg_embed(input_))
     for _ in range(max_len):
         word_logprob, hidden, attn = transducer.decode_step(
@@ -514,19 +547,76 @@ def decode_greedy(transducer,
     return output, attns
 
 
+def decode_greedy_batch(transducer,
+                        src_batch,
+                        src_mask,
+                        max_len=100,
+                        trg_bos=BOS_IDX,
+                        trg_eos=EOS_IDX):
+    '''
+    src_batch: [seq_len x batch], padded source words
+    src_mask: [seq_len x batch]
+    returns the output of each source word, all rows are decoded at once
+    until every row has produced trg_eos
+    '''
+    if isinstance(transducer, HMMTransducer):
+        return decode_greedy_hmm_batch(
+            transducer,
+            src_batch,
+            src_mask,
+            max_len=max_len,
+            trg_bos=trg_bos,
+            trg_eos=trg_eos)
+    transducer.eval()
+    device = source_device(src_batch)
+    bat_siz = src_mask.size(1)
+    enc_hs = transducer.encode(src_batch, src_mask.sum(0).long())
+
+    output = []
+    hidden = transducer.dec_rnn.get_init_hx(bat_siz, device)
+    input_ = torch.full((bat_siz, ), trg_bos, dtype=torch.long, device=device)
+    input_ = transducer.dropout(transducer.trg_embed(input_))
+    finished = torch.zeros(bat_siz, dtype=torch.bool, device=device)
+    for _ in range(max_len):
+        word_logprob, hidden, _ = transducer.decode_step(
+            enc_hs, src_mask, input_, hidden)
+        word = torch.max(word_logprob, dim=1)[1]
+        finished = finished | (word == trg_eos)
+        if finished.all():
+            break
+        input_ = transducer.dropout(transducer.trg_embed(word))
+        output.append(word)
+    return _strip_eos(output, bat_siz, trg_eos)
+
+
+def _strip_eos(output, bat_siz, trg_eos):
+    '''
+    output: list of [batch] words
+    returns the words of each row up to its first trg_eos
+    '''
+    if not output:
+        return [[] for _ in range(bat_siz)]
+    rows = torch.stack(output, dim=1).tolist()
+    for i, row in enumerate(rows):
+        if trg_eos in row:
+            rows[i] = row[:row.index(trg_eos)]
+    return rows
+
+
 def decode_greedy_hmm(transducer,
                       src_sentence,
                       max_len=100,
                       trg_bos=BOS_IDX,
                       trg_eos=EOS_IDX):
     transducer.eval()
+    device = source_device(src_sentence)
     src_mask = dummy_mask(src_sentence)
     enc_hs = transducer.encode(src_sentence)
     T = src_mask.shape[0]
 
     output, attns = [], []
-    hidden = transducer.dec_rnn.get_init_hx(1)
-    input_ = torch.tensor([trg_bos], device=DEVICE)
+    hidden = transducer.dec_rnn.get_init_hx(1, device)
+    input_ = torch.tensor([trg_bos], device=device)
     input_ = transducer.dropout(transducer.trg_embed(input_))
     for idx in range(max_len):
         trans, emiss, hidden = transducer.decode_step(enc_hs, src_mask, input_,
@@ -555,7 +645,161 @@ def decode_greedy_hmm(transducer,
     return output, attns
 
 
-Beam = namedtuple('Beam', 'seq_len log_prob hidden input partial_sent attn')
+def decode_greedy_hmm_batch(transducer,
+                            src_batch,
+                            src_mask,
+                            max_len=100,
+                            trg_bos=BOS_IDX,
+                            trg_eos=EOS_IDX):
+    '''
+    src_batch: [seq_len x batch], padded source words
+    src_mask: [seq_len x batch]
+    returns the output of each source word
+    '''
+    transducer.eval()
+    device = source_device(src_batch)
+    T, bat_siz = src_mask.shape
+    enc_hs = transducer.encode(src_batch, src_mask.sum(0).long())
+    # padded source positions are not states of the hmm
+    pad_mask = (src_mask.t() == 0).unsqueeze(1)
+
+    output = []
+    hidden = transducer.dec_rnn.get_init_hx(bat_siz, device)
+    input_ = torch.full((bat_siz, ), trg_bos, dtype=torch.long, device=device)
+    input_ = transducer.dropout(transducer.trg_embed(input_))
+    finished = torch.zeros(bat_siz, dtype=torch.bool, device=device)
+    for idx in range(max_len):
+        trans, emiss, hidden = transducer.decode_step(enc_hs, src_mask, input_,
+                                                      hidden)
+        if idx == 0:
+            forward = trans[:, 0].unsqueeze(1)
+        else:
+            forward = forward + trans.transpose(1, 2)
+            forward = forward.logsumexp(dim=-1, keepdim=True).transpose(1, 2)
+        forward = forward.masked_fill(pad_mask, -float('inf'))
+
+        log_wordprob = forward + emiss.transpose(1, 2)
+        log_wordprob = log_wordprob.logsumexp(dim=-1)
+        word = torch.max(log_wordprob, dim=-1)[1]
+        finished = finished | (word == trg_eos)
+        if finished.all():
+            break
+        input_ = transducer.dropout(transducer.trg_embed(word))
+        output.append(word)
+        word_idx = word.view(-1, 1, 1).expand(bat_siz, T, 1)
+        word_emiss = torch.gather(emiss, -1, word_idx).view(bat_siz, 1, T)
+        forward = forward + word_emiss
+    return _strip_eos(output, bat_siz, trg_eos)
+
+
+def _select_rows(enc_hs, idx):
+    '''
+    select batch rows of encoder states, idx: [new_batch]
+    '''
+    if isinstance(enc_hs[0], tuple):
+        # tag transducers return the encoder states and the attributes
+        enc_hs, attr = enc_hs
+        attr = None if attr is None else attr.index_select(0, idx)
+        return _select_rows(enc_hs, idx), attr
+    return tuple(hs.index_select(1, idx) for hs in enc_hs)
+
+
+def _beam_search(transducer, src_batch, src_mask, max_len, nb_beam, norm,
+                 trg_bos, trg_eos):
+    '''
+    beam search for a batch of source words, the beams of all source words are
+    kept as rows of one batch and expanded with a single decode step
+
+    src_batch: [seq_len x batch]
+    src_mask: [seq_len x batch]
+    returns the output and the attention weights of the best beam of each
+    source word
+    '''
+    assert not isinstance(transducer, HMMTransducer)
+    transducer.eval()
+    device = source_device(src_batch)
+    bat_siz = src_mask.size(1)
+    rows = torch.arange(bat_siz, device=device).repeat_interleave(nb_beam)
+    enc_hs = _select_rows(
+        transducer.encode(src_batch, src_mask.sum(0).long()), rows)
+    enc_mask = src_mask.index_select(1, rows)
+
+    def score(log_prob, seq_len):
+        '''
+        compute score based on logprob, lower is better
+        '''
+        return -log_prob / seq_len if norm else -log_prob
+
+    # log_prob: batch x nb_beam, only the first beam is alive at the start
+    log_prob = torch.full((bat_siz, nb_beam), -float('inf'),
+                          dtype=torch.double, device=device)
+    log_prob[:, 0] = 0
+    hidden = transducer.dec_rnn.get_init_hx(bat_siz * nb_beam, device)
+    input_ = torch.full((bat_siz * nb_beam, ), trg_bos, dtype=torch.long,
+                        device=device)
+    input_ = transducer.dropout(transducer.trg_embed(input_))
+    offset = (torch.arange(bat_siz, device=device) * nb_beam).view(-1, 1)
+    # back pointers of the beams alive after each step
+    words, parents, attns = [], [], []
+    # best finished beam of each source word: score, step and parent beam
+    best = [(float('inf'), None, None)] * bat_siz
+    for step in range(max_len):
+        word_logprob, hidden, attn = transducer.decode_step(
+            enc_hs, enc_mask, input_, hidden)
+        attns.append(attn.view(bat_siz, nb_beam, *attn.shape[1:]))
+        topk_log_prob, topk_word = word_logprob.topk(nb_beam)
+        # candidates are ordered by beam, then by rank of the word
+        cand_log_prob = (log_prob.unsqueeze(-1) + topk_log_prob.double().view(
+            bat_siz, nb_beam, nb_beam)).view(bat_siz, -1)
+        cand_word = topk_word.view(bat_siz, -1)
+        cand_score = score(cand_log_prob, step + 2)
+        is_eos = (cand_word == trg_eos) & (cand_log_prob > -float('inf'))
+        if is_eos.any():
+            eos_score = cand_score.masked_fill(~is_eos, float('inf'))
+            min_score, min_idx = eos_score.min(dim=1)
+            for b in is_eos.any(dim=1).nonzero().view(-1).tolist():
+                if min_score[b].item() < best[b][0]:
+                    best[b] = (min_score[b].item(), step,
+                               min_idx[b].item() // nb_beam)
+        # keep the nb_beam best beams that did not finish
+        cand_score = cand_score.masked_fill(
+            (cand_word == trg_eos) | (cand_log_prob == -float('inf')),
+            float('inf'))
+        _, order = cand_score.sort(dim=1, stable=True)
+        order = order[:, :nb_beam]
+        log_prob = cand_log_prob.gather(1, order)
+        log_prob = log_prob.masked_fill(
+            cand_score.gather(1, order) == float('inf'), -float('inf'))
+        word = cand_word.gather(1, order)
+        parent = order // nb_beam
+        words.append(word)
+        parents.append(parent)
+        parent_rows = (parent + offset).view(-1)
+        hidden = (hidden[0].index_select(1, parent_rows),
+                  hidden[1].index_select(1, parent_rows))
+        input_ = transducer.dropout(transducer.trg_embed(word.view(-1)))
+
+    def backtrack(b, beam, step):
+        '''
+        output and attention weights of a beam alive after step
+        '''
+        output, attn = [], []
+        for t in range(step, -1, -1):
+            output.append(words[t][b, beam].item())
+            beam = parents[t][b, beam].item()
+            attn.append(attns[t][b, beam])
+        return output[::-1], attn[::-1]
+
+    results = []
+    for b in range(bat_siz):
+        _, step, beam = best[b]
+        if step is None:
+            # no beam finished, use the best unfinished beam
+            results.append(backtrack(b, 0, max_len - 1))
+        else:
+            output, attn = backtrack(b, beam, step - 1)
+            results.append((output, attn + [attns[step][b, beam]]))
+    return results
 
 
 def decode_beam_search(transducer,
@@ -568,49 +812,24 @@ def decode_beam_search(transducer,
     '''
     src_sentence: [seq_len]
     '''
-    assert not isinstance(transducer, HMMTransducer)
-
-    def score(beam):
-        '''
-        compute score based on logprob
-        '''
-        assert isinstance(beam, Beam)
-        if norm:
-            return -beam.log_prob / beam.seq_len
-        return -beam.log_prob
-
-    transducer.eval()
     src_mask = dummy_mask(src_sentence)
-    enc_hs = transducer.encode(src_sentence)
-
-    hidden = transducer.dec_rnn.get_init_hx(1)
-    input_ = torch.tensor([trg_bos], device=DEVICE)
-    input_ = transducer.dropout(transducer.trg_embed(input_))
-    start = Beam(1, 0, hidden, input_, '', [])
-    beams = [start]
-    finish_beams = []
-    for _ in range(max_len):
-        next_beams = []
-        for beam in sorted(beams, key=score)[:nb_beam]:
-            word_logprob, hidden, attn = transducer.decode_step(
-                enc_hs, src_mask, beam.input, beam.hidden)
-            topk_log_prob, topk_word = word_logprob.topk(nb_beam)
-            topk_log_prob = topk_log_prob.view(nb_beam, 1)
-            topk_word = topk_word.view(nb_beam, 1)
-            for log_prob, word in zip(topk_log_prob, topk_word):
-                if word == trg_eos:
-                    beam = Beam(beam.seq_len + 1,
-                                beam.log_prob + log_prob.item(), None, None,
-                                beam.partial_sent, beam.attn + [attn])
-                    finish_beams.append(beam)
-                else:
-                    beam = Beam(
-                        beam.seq_len + 1, beam.log_prob + log_prob.item(),
-                        hidden, transducer.dropout(transducer.trg_embed(word)),
-                        ' '.join([beam.partial_sent,
-                                  str(word.item())]), beam.attn + [attn])
-                    next_beams.append(beam)
-        beams = next_beams
-    finish_beams = finish_beams if finish_beams else next_beams
-    max_output = sorted(finish_beams, key=score)[0]
-    return list(map(int, max_output.partial_sent.split())), max_output.attn
\ No newline at end of file
+    return _beam_search(transducer, src_sentence, src_mask, max_len, nb_beam,
+                        norm, trg_bos, trg_eos)[0]
+
+
+def decode_beam_search_batch(transducer,
+                             src_batch,
+                             src_mask,
+                             max_len=50,
+                             nb_beam=5,
+                             norm=True,
+                             trg_bos=BOS_IDX,
+                             trg_eos=EOS_IDX):
+    '''
+    src_batch: [seq_len x batch], padded source words
+    src_mask: [seq_len x batch]
+    returns the output of each source word
+    '''
+    results = _beam_search(transducer, src_batch, src_mask, max_len, nb_beam,
+                           norm, trg_bos, trg_eos)
+    return [output for output, _ in results]
@@ -0,0 +1,88 @@
+'''
+Precomputed reinflection tables
+'''
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = b'RFTABLE1'
+# magic, number of entries and model checksum padded with zeros
+HEADER = struct.Struct('<8sQ112s')
+
+
+def _entry_key(lemma, tags):
+    return ('\t'.join((''.join(lemma), ';'.join(tags)))).encode('utf-8')
+
+
+def write_table(table_file, checksum, entries):
+    '''
+    write a reinflection table
+    table_file: output file
+    checksum: checksum of the reinflection model that produced the forms
+    entries: iterable of (lemma, tags, form)
+    '''
+    forms = {
+        _entry_key(lemma, tags): form.encode('utf-8')
+        for lemma, tags, form in entries
+    }
+    records = [key + b'\t' + forms[key] for key in sorted(forms)]
+    offsets = np.zeros(len(records) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(record) for record in records])
+    with open(table_file, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, len(records), checksum.encode('ascii')))
+        fp.write(offsets.tobytes())
+        for record in records:
+            fp.write(record)
+    return len(records)
+
+
+class ReinflectionTable(object):
+    '''
+    read-only table of reinflected forms sorted by (lemma, tags). The file is
+    memory-mapped and searched in place, so opening a table does not depend
+    on its size.
+    '''
+
+    def __init__(self, table_file):
+        self.fp = open(table_file, 'rb')
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, checksum = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(table_file + ' is not a reinflection table')
+        self.checksum = checksum.rstrip(b'\0').decode('ascii')
+        self.offsets = np.frombuffer(
+            self.mm, dtype='<u8', count=self.size + 1, offset=HEADER.size)
+        self.start = HEADER.size + self.offsets.nbytes
+
+    def __len__(self):
+        return self.size
+
+    def _record(self, i):
+        start = self.start + int(self.offsets[i])
+        end = self.start + int(self.offsets[i + 1])
+        key, _, form = self.mm[start:end].rpartition(b'\t')
+        return key, form
+
+    def get(self, lemma, tags):
+        '''
+        form of lemma with tags, None if it is not in the table
+        '''
+        key = _entry_key(lemma, tags)
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            mid_key, form = self._record(mid)
+            if mid_key < key:
+                low = mid + 1
+            elif mid_key > key:
+                high = mid
+            else:
+                return form.decode('utf-8')
+        return None
+
+    def close(self):
+        # the offsets view has to be released before the map can be closed
+        self.offsets = None
+        self.mm.close()
+        self.fp.close()
@@ -1,19 +1,225 @@
-from pyconll import load_from_string
-
-
-def load_sentences(n, f):
-    count = 0
-    lines = ""
-    line = f.readline()
-    while line and count < n:
-        lines += line  # line.replace("sent_id", "sent_id =") if (opt.use_v1 and opt.get_ids) else line
-        if line == "\n":
-            count += 1
-        line = f.readline()
-    not_empty = True if line else False
+"""
+Lightweight CoNLL-U representation.
+
+Tokens only keep the columns used by the conversion pipeline (id, form, lemma, upos, feats, head and deprel) as
+attributes, and the original line for everything else. Features are only parsed when they are first accessed.
+Serializing a token that has not been modified returns its original line untouched.
+
+The classes follow the interface of pyconll (Token, Sentence and Conll), so they can be used wherever pyconll objects
+were used before.
+"""
+
+EMPTY = "_"
+
+
+def parse_feats(text):
+    """
+    :param text: FEATS column of a token
+    :return: dictionary from feature name to set of values
+    """
+    feats = dict()
+    if text == EMPTY:
+        return feats
+    for feat in text.split("|"):
+        name, _, values = feat.partition("=")
+        feats[name] = set(values.split(",")) if values else set()
+    return feats
+
+
+def format_feats(feats):
+    """
+    :param feats: dictionary from feature name to set of values
+    :return: FEATS column of a token, features and values are sorted case-insensitively
+    """
+    if not feats:
+        return EMPTY
+    return "|".join(name + "=" + ",".join(sorted(feats[name], key=str.lower))
+                    for name in sorted(feats, key=str.lower))
+
+
+def _unit(value):
+    return EMPTY if value is None else value
+
+
+class Token:
+    """
+    A token (line) of a CoNLL-U sentence
+    """
+    __slots__ = ("id", "form", "lemma", "upos", "head", "deprel", "line", "_feats")
+
+    def __init__(self, line):
+        fields = line.split("\t")
+        if len(fields) != 10:
+            raise ValueError("The number of columns per token line must be 10. Invalid token: " + line)
+        self.id = fields[0]
+        # An underscore is only an empty form and lemma if the other one is not an underscore as well
+        if fields[1] != EMPTY or fields[2] != EMPTY:
+            self.form = None if fields[1] == EMPTY else fields[1]
+            self.lemma = None if fields[2] == EMPTY else fields[2]
+        else:
+            self.form, self.lemma = fields[1], fields[2]
+        self.upos = None if fields[3] == EMPTY else fields[3]
+        self.head = None if fields[6] == EMPTY else fields[6]
+        self.deprel = None if fields[7] == EMPTY else fields[7]
+        self.line = line
+        self._feats = None
+
+    @property
+    def feats(self):
+        if self._feats is None:
+            self._feats = parse_feats(self.line.split("\t")[5])
+        return self._feats
+
+    @feats.setter
+    def feats(self, feats):
+        self._feats = feats
+
+    def is_multiword(self):
+        return "-" in self.id
+
+    def conll(self):
+        """
+        :return: CoNLL-U line of the token, the original line if the token has not been modified
+        """
+        fields = self.line.split("\t")
+        feats = fields[5]
+        if self._feats is not None:
+            feats = format_feats(self._feats)
+            if feats == format_feats(parse_feats(fields[5])):
+                feats = fields[5]
+        new_fields = [self.id, _unit(self.form), _unit(self.lemma), _unit(self.upos), fields[4], feats,
+                      _unit(self.head), _unit(self.deprel), fields[8], fields[9]]
+        if new_fields == fields:
+            return self.line
+        return "\t".join(new_fields)
+
+
+class Sentence:
+    """
+    A CoNLL-U sentence, comments are kept untouched
+    """
+    __slots__ = ("id", "comments", "tokens")
+
+    def __init__(self, text):
+        self.id = None
+        self.comments = []
+        self.tokens = []
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                self.comments.append(line)
+                key, sep, value = line[1:].partition("=")
+                if sep and key.strip() == "sent_id":
+                    self.id = value.strip()
+            else:
+                self.tokens.append(Token(line))
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, i):
+        return self.tokens[i]
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def conll(self):
+        return "\n".join(self.comments + [token.conll() for token in self.tokens])
+
+
+class Conll(list):
+    """
+    A list of CoNLL-U sentences
+    """
+    def conll(self):
+        return "\n\n".join([sentence.conll() for sentence in self] + [""])
+
+
+def read_sentences(f, offset=0):
+    """
+    Stream the sentences of a CoNLL-U file one at a time
+
+    :param f: CoNLL-U file opened in binary mode
+    :param offset: byte offset f is positioned at
+    :return: generator of (sentence text, byte offset of the sentence, byte offset after the sentence), sentences that
+    are not valid UTF-8 are reported and skipped
+    """
+    lines = []
+    start = offset
+    for line in f:
+        offset += len(line)
+        if line.strip():
+            lines.append(line)
+            continue
+        if lines:
+            text = decode_sentence(lines, start)
+            if text is not None:
+                yield text, start, offset
+            lines = []
+        start = offset
+    if lines:
+        text = decode_sentence(lines, start)
+        if text is not None:
+            yield text, start, offset
+
+
+def decode_sentence(lines, start):
+    """
+    Decode the lines of a sentence, a sentence that is not valid UTF-8 is reported instead of ending the stream
+
+    :param lines: list of lines of the sentence as bytes
+    :param start: byte offset of the sentence
+    :return: sentence text, None if the sentence is not valid UTF-8
+    """
+    data = b"".join(lines)
     try:
-        conll = load_from_string(lines)
-    except Exception:
-        conll = load_from_string("")
-        print("bad conll")
-    return conll, not_empty
\ No newline at end of file
+        return data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        print("bad conll sentence at byte offset", start, "-", "invalid UTF-8 at byte offset", start + e.start)
+        return None
+
+
+def parse_sentences(sentences):
+    """
+    Parse a list of sentences, malformed sentences are reported and skipped
+
+    :param sentences: list of (sentence text, byte offset of the sentence, byte offset after the sentence)
+    :return: Conll object
+    """
+    conll = Conll()
+    for text, start, _ in sentences:
+        try:
+            conll.append(Sentence(text))
+        except ValueError as e:
+            print("bad conll sentence at byte offset", start, "-", e)
+    return conll
+
+
+def load_partitions(f, n, offset=0):
+    """
+    Stream a CoNLL-U file in partitions of sentences
+
+    :param f: CoNLL-U file opened in binary mode
+    :param n: number of sentences per partition
+    :param offset: byte offset f is positioned at
+    :return: generator of (Conll object, byte offset after the partition), reading can be resumed from the offset with
+    f.seek(offset)
+    """
+    sentences = []
+    for sentence in read_sentences(f, offset):
+        sentences.append(sentence)
+        if len(sentences) == n:
+            yield parse_sentences(sentences), sentence[2]
+            sentences = []
+    if sentences:
+        yield parse_sentences(sentences), sentences[-1][2]
+
+
+def load_file(file):
+    """
+    :param file: CoNLL-U file name
+    :return: Conll object of all sentences in the file
+    """
+    with open(file, "rb") as f:
+        return parse_sentences(read_sentences(f))
@@ -1,4 +1,5 @@
 from utils.ud import get_rel_id, get_upos_id, get_gender_id
+from utils.tree import DependencyTree
 
 
 class Sentence:
@@ -53,7 +54,8 @@ def sample_from_sentence(sent, use_v1, hack_v2):
         tag = 0 if ('Gender' not in tok.feats or (tok.feats['Gender'] != {"Masc"} and tok.feats['Gender'] != {"Fem"}))\
             else get_gender_id(next(iter(tok.feats['Gender'])))
         m.append(tag)
-    return Sentence(T, pos, m)
+    # The tree is compiled (and validated) once, every model query on the sentence reuses it
+    return Sentence(DependencyTree(T, pos), pos, m)
 
 
 def samples_from_conll(conll, use_v1, hack_v2):
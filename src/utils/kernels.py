@@ -0,0 +1,161 @@
+import argparse
+import time
+import torch as tr
+
+"""
+Vectorized log-space kernels for message passing.
+
+All kernels work on tensors with arbitrary leading batch dimensions, which are broadcast like in torch.matmul, and are
+numerically stable: log-space products are reduced with a logsumexp over all terms instead of being exponentiated with
+a shared offset, so they do not underflow to -inf when psi is peaked.
+"""
+
+
+def logsumexp(A, dim=None, keepdim=False):
+    """
+    Addition of log values
+    :param A: torch.tensor
+    :param dim: dimension (or tuple of dimensions) to reduce, None to reduce all elements
+    :param keepdim: True if the reduced dimensions should be kept with size 1
+    :return: the logsumexp of A along dim, -inf if all values are -inf
+    """
+    if dim is None:
+        dim = tuple(range(A.dim()))
+    return tr.logsumexp(A, dim, keepdim)
+
+
+def logsumexp_index(A, index, size):
+    """
+    Addition of log values grouped by the rows of a tensor
+    :param A: torch.tensor
+    :param index: group of each row of A
+    :param size: number of groups
+    :return: tensor with the logsumexp of the rows of A in each group, -inf for groups without rows
+    """
+    shape = (size,) + A.shape[1:]
+    index = index.view((-1,) + (1,) * (A.dim() - 1)).expand_as(A)
+    offset = tr.full(shape, -float('inf'), dtype=A.dtype).scatter_reduce(0, index, A, 'amax')
+    # Groups that are -inf everywhere stay -inf instead of becoming nan
+    offset = offset.masked_fill(tr.isinf(offset), 0)
+    A_exp = tr.exp(A - offset.gather(0, index))
+    return offset + tr.log(tr.zeros(shape, dtype=A.dtype).scatter_add(0, index, A_exp))
+
+
+def _products(A, B, use_log):
+    """
+    :param A: tensor of dimensions (..., m, r) or vector of length r
+    :param B: tensor of dimensions (..., r, n) or vector of length r
+    :param use_log: True if A and B are in log space
+    :return: tensor of dimensions (..., m, r, n) of all products A[..., i, k] B[..., k, j], and a function that removes
+    the dimensions added for vectors from a result of dimensions (..., m, n)
+    """
+    squeeze = []
+    if A.dim() == 1:
+        A = A.unsqueeze(0)
+        squeeze.append(-2)
+    if B.dim() == 1:
+        B = B.unsqueeze(1)
+        squeeze.append(-1)
+    products = A.unsqueeze(-1) + B.unsqueeze(-3) if use_log else A.unsqueeze(-1) * B.unsqueeze(-3)
+
+    def squeeze_vectors(C):
+        for d in sorted(squeeze):
+            C = C.squeeze(d)
+        return C
+    return products, squeeze_vectors
+
+
+def logmatmul(A, B):
+    """
+    Matrix multiplication in log space
+
+    :param A: tensor of dimensions (..., m, r) or vector of length r
+    :param B: tensor of dimensions (..., r, n) or vector of length r
+    :return: matrix multiplication AB in log-space, vector dimensions are removed like in torch.matmul
+    """
+    products, squeeze_vectors = _products(A, B, True)
+    return squeeze_vectors(tr.logsumexp(products, -2))
+
+
+def maxmul(A, B, use_log=True):
+    """
+    Matrix multiplication for max-product
+
+    :param A: tensor of dimensions (..., m, r) or vector of length r
+    :param B: tensor of dimensions (..., r, n) or vector of length r
+    :param use_log: True if operations should be done in log space, False otherwise
+    :return: matrix multiplication AB for max-product and the index k of the best product A[..., i, k] B[..., k, j] of
+    each entry, vector dimensions are removed like in torch.matmul
+    """
+    products, squeeze_vectors = _products(A, B, use_log)
+    res, arg_res = tr.max(products, -2)
+    return squeeze_vectors(res), squeeze_vectors(arg_res)
+
+
+def _time(fn, *args, repeat=100):
+    start = time.time()
+    for _ in range(repeat):
+        res = fn(*args)
+    return (time.time() - start) / repeat * 1e6, res
+
+
+def main():
+    """
+    Compare the kernels with the functions in utils.math, which compute one product or logsumexp at a time
+    """
+    import utils.math as reference
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tags', default=3, type=int, help='Number of tags')
+    parser.add_argument('--batch', default=64, type=int, help='Number of messages per batched call')
+    parser.add_argument('--scale', default=100, type=float, help='Scale of the random potentials, large is peaked')
+    opt = parser.parse_args()
+    tr.manual_seed(0)
+    K = opt.tags
+    a = tr.randn(K, dtype=tr.float64) * opt.scale
+    psi = tr.randn(K, K, dtype=tr.float64) * opt.scale
+    msgs = tr.randn(opt.batch, 1, K, dtype=tr.float64) * opt.scale
+    psis = tr.randn(opt.batch, K, K, dtype=tr.float64) * opt.scale
+    # logsumexp over the first dimension of 8 x K x K cells, like the psi marginals of 8 edges
+    cells = tr.randn(opt.batch, 8, K, K, dtype=tr.float64) * opt.scale
+
+    print('{:<14} {:>12} {:>12} {:>12} {:>10}'.format('kernel', 'reference', 'kernel', 'batched', 'max diff'))
+
+    def report(name, ref_fn, ref_args, kernel_fn, kernel_args, batch_fn, batch_args, compare):
+        # times per product, the batched kernel computes opt.batch products at once
+        ref_time, ref_res = _time(ref_fn, *ref_args)
+        kernel_time, kernel_res = _time(kernel_fn, *kernel_args)
+        batch_time, batch_res = _time(batch_fn, *batch_args)
+        diff = compare(ref_res, kernel_res, batch_res)
+        print('{:<14} {:>10.1f}us {:>10.1f}us {:>10.1f}us {:>10.1e}'.format(
+            name, ref_time, kernel_time, batch_time / opt.batch, diff))
+
+    def max_diff(x, y):
+        finite = tr.isfinite(x) & tr.isfinite(y)
+        return float((x[finite] - y[finite]).abs().max()) if finite.any() else 0.
+
+    report('logmatmul', reference.logmatmul, (a.view(1, K), psi), logmatmul, (a, psi), logmatmul, (msgs, psis),
+           lambda ref, res, batch: max(max_diff(ref.view(-1), res),
+                                       max(max_diff(reference.logmatmul(msgs[b], psis[b]), batch[b])
+                                           for b in range(opt.batch))))
+
+    def compare_maxmul(ref, res, batch):
+        assert tr.equal(ref[1].long(), res[1]), 'back pointers differ'
+        for b in range(opt.batch):
+            ref_b = reference.maxmul(msgs[b, 0], psis[b], True)
+            assert tr.equal(ref_b[1].long(), batch[1][b, 0]), 'batched back pointers differ'
+        return max_diff(ref[0], res[0])
+    report('maxmul', reference.maxmul, (a, psi, True), maxmul, (a, psi), maxmul, (msgs, psis), compare_maxmul)
+
+    report('logsumexp_mat', reference.logsumexp_mat, (cells[0],), logsumexp, (cells[0], 0), logsumexp, (cells, 1),
+           lambda ref, res, batch: max(max_diff(ref, res), max(max_diff(reference.logsumexp_mat(cells[b]), batch[b])
+                                                               for b in range(opt.batch))))
+
+    # With peaked potentials the reference, which shares one offset for all of A and one for all of B, underflows
+    peaked_a = tr.tensor([0., -800.], dtype=tr.float64)
+    peaked_psi = tr.tensor([[-800., 0.], [0., -800.]], dtype=tr.float64)
+    print('peaked logmatmul: reference', reference.logmatmul(peaked_a.view(1, 2), peaked_psi).view(-1).tolist(),
+          'kernel', logmatmul(peaked_a, peaked_psi).tolist())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import unicodedata
+
+
+class AnimacyLexicon:
+    """
+    Lexicon of animate noun pairs, indexed by the feminine and the masculine word so that looking up a lemma does not
+    depend on the size of the lexicon
+    """
+    def __init__(self, pairs, lowercase=False, normalization=None):
+        """
+        :param pairs: list of English-Feminine-Masculine word triples
+        :param lowercase: True if words should be matched case-insensitively
+        :param normalization: Unicode normalization form used to match words (NFC, NFD, NFKC or NFKD), None for no
+        normalization
+        """
+        self.pairs = pairs
+        self.lowercase = lowercase
+        self.normalization = normalization
+        # Map from normalized word to its counterpart of the other gender, the first pair containing a word wins
+        self._fem_words = dict()
+        self._masc_words = dict()
+        for _, fem, masc in pairs:
+            self._fem_words.setdefault(self.normalize(masc), fem)
+            self._masc_words.setdefault(self.normalize(fem), masc)
+
+    def normalize(self, word):
+        """
+        :param word: word
+        :return: word as it is used as key in the lexicon
+        """
+        if self.normalization is not None:
+            word = unicodedata.normalize(self.normalization, word)
+        if self.lowercase:
+            word = word.lower()
+        return word
+
+    def __contains__(self, word):
+        if word is None:
+            return False
+        word = self.normalize(word)
+        return word in self._fem_words or word in self._masc_words
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def get_fem_word(self, masc_word):
+        """
+        :param masc_word: masculine word to convert
+        :return: feminine inflection of masculine word
+        """
+        try:
+            return self._fem_words[self.normalize(masc_word)]
+        except KeyError:
+            raise ValueError(masc_word)
+
+    def get_masc_word(self, fem_word):
+        """
+        :param fem_word: feminine word to convert
+        :return: masculine inflection of feminine word
+        """
+        try:
+            return self._masc_words[self.normalize(fem_word)]
+        except KeyError:
+            raise ValueError(fem_word)
+
+    def get_counterpart(self, word, is_masc):
+        """
+        :param word: word to convert
+        :param is_masc: True if word is masculine
+        :return: inflection of word of the other gender
+        """
+        return self.get_fem_word(word) if is_masc else self.get_masc_word(word)
+
+
+_lexicons = dict()
+
+
+def load_lexicon(animate_file, lowercase=False, normalization=None):
+    """
+    Load a lexicon of animate noun pairs, every file is only read once per process
+
+    :param animate_file: file containing tab separated English-Feminine-Masculine word triples
+    :param lowercase: True if words should be matched case-insensitively
+    :param normalization: Unicode normalization form used to match words, None for no normalization
+    :return: AnimacyLexicon
+    """
+    key = (animate_file, lowercase, normalization)
+    if key not in _lexicons:
+        with open(animate_file, "r") as f:
+            pairs = [tuple(line.strip().split("\t")) for line in f if line.strip()]
+        _lexicons[key] = AnimacyLexicon(pairs, lowercase, normalization)
+    return _lexicons[key]
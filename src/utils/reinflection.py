@@ -1,4 +1,5 @@
-from pyconll import load_from_file
+from copy import copy
+from utils.conll import load_file
 
 
 def get_feats(token):
@@ -16,6 +17,31 @@ def get_feats(token):
     return feats
 
 
+def flip_gender(token):
+    """
+    :param token: token with a single gender
+    :return: copy of the token with the other gender, the token itself is not modified
+    """
+    is_masc = next(iter(token.feats['Gender'])) == 'Masc'
+    token = copy(token)
+    token.feats = dict(token.feats, Gender={'Fem' if is_masc else 'Masc'})
+    return token
+
+
+def get_gendered_words(conll):
+    """
+    :param conll: collection of UD parsed sentences
+    :return: set of lemma-feature pairs the reinflection model is asked for when the gender of a word changes
+    """
+    words = set()
+    for sent in conll:
+        for tok in sent:
+            if tok.is_multiword() or not tok.lemma or 'Gender' not in tok.feats or len(tok.feats['Gender']) != 1:
+                continue
+            words.add((tok.lemma, tuple(get_feats(flip_gender(tok)))))
+    return words
+
+
 def get_lines(conll):
     """
     :param conll: PyConll object
@@ -43,7 +69,7 @@ def create_reinflection_file(in_file, out_file):
     :param in_file: UD annotated input file name
     :param out_file: output file name
     """
-    conll = load_from_file(in_file)
+    conll = load_file(in_file)
     lines = get_lines(conll)
     with open(out_file, "w") as f:
         f.writelines(lines)
@@ -5,6 +5,9 @@ node i to node j with label l.
 Trees are given in order of i (i.e. [(0, j_0, l_0), (1, j_1, l_1), ...] and -1 marks the imaginary root node.
 
 It is assumed label l=0 is the 'root' dependency
+
+A DependencyTree compiles such a list once, so that tree queries do not scan the edges. It behaves like the list of
+edges, and every function of this module accepts either representation.
 """
 
 
@@ -13,6 +16,8 @@ def get_root(T):
     :param T: tree
     :return: root node of the tree
     """
+    if isinstance(T, DependencyTree):
+        return T.root
     root_found = False
     root = 1
     for (i, j, l) in T:
@@ -48,6 +53,8 @@ def get_children(T, j):
     :param j: node
     :return: list of child-node, label tuples of children
     """
+    if isinstance(T, DependencyTree):
+        return T.children(j)
     labels = []
     for (i, k, l) in T:
         if j == k:
@@ -63,6 +70,8 @@ def get_head(T, i):
     """
     if 1 > i or i > len(T):
         raise ValueError(str(i) + " must be an index of the tree (0 < i <= " + str(len(T)) + ")")
+    if isinstance(T, DependencyTree):
+        return T.heads[i - 1], T.labels[i - 1]
     for (k, j, l) in T:
         if i == k:
             return j, l
@@ -122,6 +131,9 @@ def validate_tree(T):
     :param T: tree
     :return: True if T is indeed a tree, False otherwise
     """
+    if isinstance(T, DependencyTree):
+        # DependencyTrees are validated when they are built
+        return True, ""
     try:
         get_root(T)
     except ValueError as e:
@@ -142,3 +154,129 @@ def label_used(T, lab):
         if l == lab:
             used.append((i, j))
     return used
+
+
+def _compile_levels(T):
+    """
+    :param T: tree as a list of edges
+    :return: list of heads, list of labels, lists of children of each node (children[0] == [root]) and list of levels
+    """
+    root = None
+    heads, labels = [], []
+    children = [[] for _ in range(len(T) + 1)]
+    for x in range(1, len(T) + 1):
+        i, j, l = T[x - 1]
+        if i != x or not 0 <= j <= len(T):
+            raise ValueError("Tree does not contain the right indexes or indexes are not in the right order")
+        if j == 0:
+            if root is not None:
+                raise ValueError("Tree cannot have more than one root!")
+            root = i
+        heads.append(j)
+        labels.append(l)
+        children[j].append(i)
+    if root is None:
+        raise ValueError("Tree does not have a root! All trees must have a root")
+    levels = [[root]]
+    reached = 1
+    while True:
+        level = [i for j in levels[-1] for i in children[j]]
+        if not level:
+            break
+        reached += len(level)
+        levels.append(level)
+    if reached != len(T):
+        raise ValueError("Tree contains cycles or at least one unconnected node")
+    return heads, labels, children, levels
+
+
+def get_levels(T):
+    """
+    Group the nodes of a tree by their depth. The tree is validated while it is traversed, so a single linear pass
+    replaces validate_tree
+
+    :param T: tree
+    :return: list of heads (heads[i - 1] is the head of node i), list of labels, list of levels where levels[d] contains
+    all nodes at depth d (levels[0] == [root])
+    """
+    if isinstance(T, DependencyTree):
+        return T.heads, T.labels, T.levels
+    heads, labels, _, levels = _compile_levels(T)
+    return heads, labels, levels
+
+
+class DependencyTree:
+    """
+    Dependency tree compiled from its list of (i, j, l) edges. Heads, labels, children, depths and the breadth-first
+    order of the nodes are stored when the tree is built, which also validates it, so tree queries take constant time
+    (or time linear in the answer). Iterating over, indexing and taking the length of a DependencyTree behave like the
+    list of edges
+    """
+    def __init__(self, T, pos=None):
+        """
+        :param T: tree as a list of edges
+        :param pos: list of pos tags, pos[i - 1] is the tag of node i
+        """
+        self.edges = [tuple(edge) for edge in T]
+        self.heads, self.labels, children, self.levels = _compile_levels(self.edges)
+        self.pos = list(pos) if pos is not None else None
+        self.root = self.levels[0][0]
+        # Children in CSR layout, the children of node j are child_idx[child_ptr[j]:child_ptr[j + 1]] in index order
+        self.child_ptr = [0]
+        self.child_idx = []
+        for node_children in children:
+            self.child_idx.extend(node_children)
+            self.child_ptr.append(len(self.child_idx))
+        self.order = [i for level in self.levels for i in level]
+        self.depth = [0] * len(self.edges)
+        for d, level in enumerate(self.levels):
+            for i in level:
+                self.depth[i - 1] = d
+
+    def __len__(self):
+        return len(self.edges)
+
+    def __iter__(self):
+        return iter(self.edges)
+
+    def __getitem__(self, idx):
+        return self.edges[idx]
+
+    def __repr__(self):
+        return "DependencyTree(" + repr(self.edges) + ")"
+
+    def head(self, i):
+        """
+        :param i: node
+        :return: head node and label of i
+        """
+        return get_head(self, i)
+
+    def children(self, j):
+        """
+        :param j: node, 0 for the imaginary root node
+        :return: list of child-node, label tuples of children
+        """
+        if not 0 <= j <= len(self.edges):
+            return []
+        return [(i, self.labels[i - 1]) for i in self.child_idx[self.child_ptr[j]:self.child_ptr[j + 1]]]
+
+    def not_root(self):
+        """
+        :return: all node indices that are not the root
+        """
+        return [i for i in range(1, len(self.edges) + 1) if i != self.root]
+
+
+def as_tree(T, pos=None):
+    """
+    Convert a list of edges to a DependencyTree, DependencyTrees are returned unchanged
+
+    :param T: tree
+    :param pos: list of pos tags
+    :return: DependencyTree of T
+    :raises ValueError: if T is not a tree
+    """
+    if isinstance(T, DependencyTree):
+        return T
+    return DependencyTree(T, pos)